@@ -1,10 +1,30 @@
 import streamlit as st
 import pandas as pd
-import google.generativeai as genai
 import re
 import logging
+import random
+import threading
+import argparse
+import functools
+import importlib
+import multiprocessing
+import sys
+from collections import deque
+import gzip
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+import hashlib
+import json
 import os
+import sqlite3
+from pandas.api.types import union_categoricals
+from streamlit import logger as streamlit_logger
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# google.generativeai (about a second to import) and pyarrow.parquet are imported by the functions
+# that use them, so page loads, job workers and the fake backend do not pay for them up front
 
 # Set up logging
 logging.basicConfig(
@@ -93,6 +113,26 @@ ManageEngine's product suite presents a comprehensive solution for organizations
     ]
 }
 
+MODEL_NAME = "gemini-2.5-pro-exp-03-25"
+# Models the router can spread requests over, with their default free-tier quotas
+MODEL_LIMITS = {
+    "gemini-2.5-pro-exp-03-25": {"rpm": 5, "tpm": 250000, "rpd": 25},
+    "gemini-2.0-flash": {"rpm": 15, "tpm": 1000000, "rpd": 1500},
+    "gemini-2.0-flash-lite": {"rpm": 30, "tpm": 1000000, "rpd": 1500},
+    "gemini-1.5-flash": {"rpm": 15, "tpm": 1000000, "rpd": 1500},
+}
+# Default model order per kind of work: bulk runs favour fast models, samples the strongest one
+MODEL_TIERS = {
+    "bulk": ["gemini-2.0-flash", "gemini-2.0-flash-lite", MODEL_NAME],
+    "sample": [MODEL_NAME, "gemini-2.0-flash"],
+}
+PREFIX_CACHE_TTL_SECONDS = 3600
+# Smallest prompt prefix Gemini context caching accepts, in tokens; shorter prefixes are not uploaded
+DEFAULT_MIN_CACHED_PREFIX_TOKENS = 4096
+MIN_CACHED_PREFIX_TOKENS = {"gemini-1.5-flash": 32768}
+
+REQUIRED_COLUMNS = ['First Name', 'Last Name', 'Company', 'Role', 'Industry', 'Country']
+
 # Define CTA options
 CTA_OPTIONS = {
     "Demo Request": "Would you be open to a quick demo this week to see how OpManager Plus can streamline your endpoint management?",
@@ -103,51 +143,21 @@ CTA_OPTIONS = {
 }
 
 
-# Email verification functions
-def validate_zoho_email(email):
-    """Validate if the email is a valid zohocorp.com email"""
-    pattern = r'^[a-zA-Z0-9._%+-]+@zohocorp\.com$'
-    return bool(re.match(pattern, email))
-
-
-def log_user_access(email):
-    """Log user access with timestamp and email"""
-    logging.info(f"Tool accessed by: {email}")
-
+PRODUCT_FEATURES_TEXT = ", ".join(ITOM['features'])
 
-def initialize_session_state():
-    """Initialize session state variables"""
-    if 'email_verified' not in st.session_state:
-        st.session_state.email_verified = False
-    if 'user_email' not in st.session_state:
-        st.session_state.user_email = ""
-    if 'api_key' not in st.session_state:
-        st.session_state.api_key = ""
-    if 'genai_initialized' not in st.session_state:
-        st.session_state.genai_initialized = False
-    if 'template' not in st.session_state:
-        st.session_state.template = """You are an expert B2B email writer with extensive experience in crafting highly personalized, engaging emails.
+# Static instructions and product briefing, rendered once per run and sent as the prompt prefix
+PROMPT_TEMPLATE = """You are an expert B2B email writer with extensive experience in crafting highly personalized, engaging emails.
 Generate exactly three paragraphs of body text (no greeting, no subject line, no extra lines, no signature, no placeholder text for CTA, etc.), and ensure the text directly addresses the recipient using second-person pronouns like you, your, yourself.
 
 Do not write in third person.
 
-Incorporate this custom context: {custom_text}
-
-Generate for:
-First Name: {first_name}
-Last Name: {last_name}
-Company: {company}
-Role: {role}
-Industry: {industry}
-Country: {country}
+Each request gives you the recipient's details, a custom context to incorporate and the selected CTA.
 
 Product Information:
 Name: OpManager Plus
 Description: {product_description}
 Features: {product_features}
 
-Selected CTA: {cta}
-
 Follow these guidelines:
 
 Write naturally as if you're a human sales professional
@@ -166,26 +176,72 @@ Present the value proposition of OpManager Plus by addressing their specific nee
 Demonstrate how OpManager Plus can benefit their role and organization, concluding with the CTA (incorporate custom text if relevant).
     """
 
+# Per-contact suffix, the only part of the prompt that changes between rows
+ROW_PROMPT_TEMPLATE = """Incorporate this custom context: {custom_text}
+
+Generate for:
+First Name: {first_name}
+Last Name: {last_name}
+Company: {company}
+Role: {role}
+Industry: {industry}
+Country: {country}
+
+Selected CTA: {cta}
+"""
+
+DEFAULT_GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 60000,
+}
+
+
+# Email verification functions
+def validate_zoho_email(email):
+    """Validate if the email is a valid zohocorp.com email"""
+    pattern = r'^[a-zA-Z0-9._%+-]+@zohocorp\.com$'
+    return bool(re.match(pattern, email))
+
+
+def log_user_access(email):
+    """Log user access with timestamp and email"""
+    logging.info(f"Tool accessed by: {email}")
+
+
+def initialize_session_state():
+    """Initialize session state variables"""
+    if 'email_verified' not in st.session_state:
+        st.session_state.email_verified = False
+    if 'user_email' not in st.session_state:
+        st.session_state.user_email = ""
+    if 'api_key' not in st.session_state:
+        st.session_state.api_key = ""
+    if 'genai_initialized' not in st.session_state:
+        st.session_state.genai_initialized = False
+    if 'template' not in st.session_state:
+        st.session_state.template = PROMPT_TEMPLATE
+    if 'row_template' not in st.session_state:
+        st.session_state.row_template = ROW_PROMPT_TEMPLATE
+
 
 def initialize_gemini(api_key):
-    """Initialize Gemini model with provided API key"""
+    """Initialize Gemini model with provided API key(s), separated by commas"""
     try:
-        genai.configure(api_key=api_key)
+        # Each key uses its own shared clients, so sessions never touch the process-global genai.configure
+        registry = get_client_registry()
+        key_pool = ApiKeyPool(parse_api_keys(api_key), client_factory=registry.clients)
         # Configure default generation config
-        generation_config = {
-            "temperature": 0.7,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 60000,
-        }
+        generation_config = dict(DEFAULT_GENERATION_CONFIG)
 
         # Initialize Gemini Pro model
-        model = genai.GenerativeModel(
-            model_name="gemini-2.5-pro-exp-03-25",
-            generation_config=generation_config
-        )
+        model = registry.model(key_pool.keys[0].api_key, MODEL_NAME, generation_config)
 
         st.session_state.model = model
+        st.session_state.key_pool = key_pool
+        st.session_state.generation_config = generation_config
+        st.session_state.model_routes = {}
         st.session_state.genai_initialized = True
         return True
     except Exception as e:
@@ -225,7 +281,8 @@ def api_key_form():
     api_key = st.sidebar.text_input(
         "Enter your Gemini API Key",
         type="password",
-        help="Enter your Google AI Studio API key for Gemini"
+        help="Enter your Google AI Studio API key for Gemini. Separate several keys with commas to pool "
+             "their quotas"
     )
 
     if api_key:
@@ -240,14 +297,18 @@ def api_key_form():
     return False
 
 
+def is_clean_paragraph(p):
+    """Skip empty paragraphs or those that might be formatting elements"""
+    return bool(p) and not p.startswith('---') and not p.startswith('#')
+
+
 def parse_email_paragraphs(email_content):
     """Split email content into three paragraphs."""
     paragraphs = email_content.strip().split('\n\n')
     clean_paragraphs = []
 
     for p in paragraphs:
-        # Skip empty paragraphs or those that might be formatting elements
-        if p and not p.startswith('---') and not p.startswith('#'):
+        if is_clean_paragraph(p):
             clean_paragraphs.append(p)
 
     while len(clean_paragraphs) < 3:
@@ -256,78 +317,2873 @@ def parse_email_paragraphs(email_content):
     return clean_paragraphs[:3]
 
 
+# Single emails are requested as JSON with one field per paragraph instead of free text
+EMAIL_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "paragraph1": {"type": "string"},
+        "paragraph2": {"type": "string"},
+        "paragraph3": {"type": "string"},
+    },
+    "required": ["paragraph1", "paragraph2", "paragraph3"],
+}
+
+EMAIL_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": EMAIL_RESPONSE_SCHEMA,
+}
+
+
+def email_response_json(paragraphs):
+    """Serialize three paragraphs in the shape of EMAIL_RESPONSE_SCHEMA."""
+    return json.dumps({f"paragraph{i}": paragraph for i, paragraph in enumerate(paragraphs[:3], 1)})
+
+
+def parse_email_response(response_text):
+    """Return the three paragraphs of a JSON email response.
+
+    Free-text responses (error messages, or cache entries from before structured output)
+    fall back to parse_email_paragraphs.
+    """
+    text = re.sub(r'^```(?:json)?\s*|\s*```$', '', response_text.strip())
+    try:
+        item = json.loads(text)
+    except ValueError:
+        return parse_email_paragraphs(response_text)
+    if not isinstance(item, dict):
+        return parse_email_paragraphs(response_text)
+    return [str(item.get(f"paragraph{i}") or "").strip() for i in range(1, 4)]
+
+
+# Writing rules of the prompt template that can be checked on the output, found by these keywords
+QUALITY_RULE_KEYWORDS = {
+    "second_person": ("second-person", "second person"),
+    "no_placeholders": ("placeholder",),
+    "no_signature": ("signature",),
+}
+
+QUALITY_ISSUES = {
+    "empty": "is empty",
+    "second_person": "does not address the recipient as you",
+    "no_placeholders": "contains placeholder text",
+    "no_signature": "ends with a sign-off or signature",
+}
+
+SECOND_PERSON_PATTERN = re.compile(r"\b(?:you|your|yours|yourself|yourselves)\b", re.IGNORECASE)
+# Angle brackets only count around a name like <Company Name>, not in comparisons like "< 5 ms"
+PLACEHOLDER_PATTERN = re.compile(r"\[[^\]\n]*\]|\{[^}\n]*\}|<[A-Za-z_](?:[A-Za-z_ ]*[A-Za-z_])?>|\bX{3,}\b|\bTBD\b")
+SIGNATURE_PATTERN = re.compile(
+    r"^\s*(?:best(?: regards| wishes)?|kind regards|warm regards|regards|sincerely|cheers|thanks|thank you|"
+    r"all the best)\s*[,.!]?\s*$",
+    re.IGNORECASE | re.MULTILINE
+)
+
+
+def template_quality_rules(template=None):
+    """Rules from QUALITY_RULE_KEYWORDS that the prompt template asks the model to follow."""
+    if template is None:
+        template = st.session_state.template
+    text = template.lower()
+    return [rule for rule, keywords in QUALITY_RULE_KEYWORDS.items() if any(word in text for word in keywords)]
+
+
+def validate_email_paragraphs(paragraphs, rules):
+    """Check three paragraphs against ``rules``; returns a list of (paragraph index, rule) violations.
+
+    Second person is a rule for the whole email; when no paragraph addresses the recipient,
+    the opening paragraph is the one flagged for repair.
+    """
+    issues = []
+    if "second_person" in rules and any(paragraphs) and not any(
+            SECOND_PERSON_PATTERN.search(paragraph) for paragraph in paragraphs):
+        issues.append((0, "second_person"))
+    for index, paragraph in enumerate(paragraphs):
+        if not paragraph:
+            issues.append((index, "empty"))
+            continue
+        if "no_placeholders" in rules and PLACEHOLDER_PATTERN.search(paragraph):
+            issues.append((index, "no_placeholders"))
+        if "no_signature" in rules and SIGNATURE_PATTERN.search(paragraph):
+            issues.append((index, "no_signature"))
+    return issues
+
+
+def format_quality_issues(issues):
+    return "; ".join(f"paragraph {index + 1} {QUALITY_ISSUES[rule]}" for index, rule in issues)
+
+
+def format_quality(quality):
+    """One-line quality verdict of a row, as shown in the Quality column."""
+    if not quality:
+        return ""
+    if quality["status"] == "failed":
+        return f"failed: {format_quality_issues(quality['issues'])}"
+    return quality["status"]
+
+
+def quality_report(qualities, report=None):
+    """Summarize the row quality results of a run: verdicts, repair requests and rules broken before repair.
+
+    Counts are added to ``report`` when given, so a run can be summarized as its rows finish.
+    """
+    if report is None:
+        report = {"passed": 0, "repaired": 0, "failed": 0, "error": 0, "repair_requests": 0, "issues_found": {}}
+    for quality in qualities:
+        if not quality:
+            continue
+        report[quality["status"]] += 1
+        report["repair_requests"] += quality.get("repairs", 0)
+        for rule in quality.get("found", []):
+            report["issues_found"][rule] = report["issues_found"].get(rule, 0) + 1
+    return report
+
+
+def format_quality_report(report):
+    text = (f"Quality: {report['passed']} passed · {report['repaired']} repaired · {report['failed']} failed · "
+            f"{report['repair_requests']} repair requests")
+    if report["issues_found"]:
+        text += " · broken before repair: " + ", ".join(
+            f"{QUALITY_ISSUES[rule]} ×{count}" for rule, count in report["issues_found"].items())
+    return text
+
+
 import time
 
 
-def generate_email_content(prompt):
-    """Generate email content using Gemini model with rate limit handling."""
-    retry_count = 0
-    max_retries = 5
-    delay = 60  # start with 60 seconds
+def build_prompt_prefix(template=None):
+    """Render the static instructions and product briefing shared by every row of a run."""
+    if template is None:
+        template = st.session_state.template
+    return template.format(
+        product_description=ITOM['description'],
+        product_features=PRODUCT_FEATURES_TEXT
+    )
+
+
+def build_email_prompt(row, cta_text, custom_text, row_template=None):
+    """Render the per-row prompt suffix for a single contact row."""
+    if row_template is None:
+        row_template = st.session_state.row_template
+    return row_template.format(
+        first_name=row['First Name'],
+        last_name=row['Last Name'],
+        company=row['Company'],
+        role=row['Role'],
+        industry=row['Industry'],
+        country=row['Country'],
+        cta=cta_text,
+        custom_text=custom_text
+    )
+
+
+# Contact lists are read in chunks of this many rows, with every field as a string
+LEAD_CHUNK_ROWS = 10000
+# Columns with few distinct values, stored as categoricals
+LEAD_CATEGORY_COLUMNS = ['Role', 'Industry', 'Country']
+# Rows of an upload shown (and selectable) in the preview
+PREVIEW_ROWS = 200
+
+
+def read_leads_csv(source, chunk_size=LEAD_CHUNK_ROWS):
+    """Read a contact CSV chunk by chunk into a compact DataFrame.
+
+    Fields are read as strings (no type inference, blanks stay ""), the columns are
+    validated on the first chunk only, and low-cardinality columns become categoricals,
+    so a large upload never exists as a full object-dtype frame. Raises ValueError when
+    required columns are missing.
+    """
+    chunks = []
+    for chunk_number, chunk in enumerate(pd.read_csv(source, chunksize=chunk_size, dtype=str,
+                                                     keep_default_na=False)):
+        if chunk_number == 0 and not all(col in chunk.columns for col in REQUIRED_COLUMNS):
+            raise ValueError(f"CSV must contain these columns: {', '.join(REQUIRED_COLUMNS)}")
+        for col in LEAD_CATEGORY_COLUMNS:
+            chunk[col] = chunk[col].astype("category")
+        chunks.append(chunk)
+    if not chunks:
+        raise ValueError(f"CSV must contain these columns: {', '.join(REQUIRED_COLUMNS)}")
+    columns = {}
+    for col in list(chunks[0].columns):
+        # pd.concat would turn categoricals with different categories per chunk back into strings
+        parts = [chunk[col] for chunk in chunks]
+        columns[col] = (pd.Series(union_categoricals(parts)) if col in LEAD_CATEGORY_COLUMNS
+                        else pd.concat(parts, ignore_index=True))
+        del parts
+        # Drop each column from the chunks once copied, so the upload is never held twice
+        for chunk in chunks:
+            del chunk[col]
+    return pd.DataFrame(columns, copy=False)
+
+
+class LeadRows:
+    """Read-only sequence of a DataFrame's rows as dicts, built when accessed instead of copied up front."""
+
+    def __init__(self, df):
+        self.columns = list(df.columns)
+        self._arrays = [df[col].array for col in self.columns]
+        self._length = len(df)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, pos):
+        return {col: array[pos] for col, array in zip(self.columns, self._arrays)}
+
+
+# Ping idle gRPC connections so reused clients do not find them dropped between bursts
+GRPC_KEEPALIVE_OPTIONS = [
+    ("grpc.keepalive_time_ms", 5 * 60 * 1000),
+    ("grpc.keepalive_timeout_ms", 20 * 1000),
+    ("grpc.keepalive_permit_without_calls", 1),
+]
+
+
+def keepalive_client(client_class, api_key):
+    """Service client bound to one API key whose gRPC channel keeps its connection alive."""
+    transport_class = client_class.get_transport_class("grpc")
+
+    def create_channel(host, options=(), **kwargs):
+        return transport_class.create_channel(host, options=list(options) + GRPC_KEEPALIVE_OPTIONS, **kwargs)
+
+    return client_class(client_options={"api_key": api_key},
+                        transport=functools.partial(transport_class, channel=create_channel))
+
+
+def gemini_clients(api_key):
+    """Generative and cache service clients bound to one API key, independent of genai.configure."""
+    from google.ai import generativelanguage as glm
+    return {
+        "generative": keepalive_client(glm.GenerativeServiceClient, api_key),
+        "cache": keepalive_client(glm.CacheServiceClient, api_key),
+    }
+
+
+# Private parts of google-generativeai are used below, so requirements.txt pins this release
+GENAI_VERSION = "0.8.6"
+
+
+def genai_private(obj, name):
+    """Private attribute of a google-generativeai object, failing loudly if the installed release lacks it."""
+    if not hasattr(obj, name):
+        import google.generativeai as genai
+        owner = getattr(obj, '__name__', type(obj).__name__)
+        raise RuntimeError(f"google-generativeai {genai.__version__} has no {owner}.{name}, which this app "
+                           f"relies on; install google-generativeai=={GENAI_VERSION}")
+    return getattr(obj, name)
+
+
+def bind_model_client(model, client):
+    """Send a GenerativeModel's requests through ``client`` instead of the process-global one."""
+    genai_private(model, '_client')
+    model._client = client
+
+
+def parse_api_keys(text):
+    """Split a comma- or newline-separated list of API keys, dropping blanks and duplicates."""
+    keys = [key.strip() for key in re.split(r'[,\s]+', text or "") if key.strip()]
+    return list(dict.fromkeys(keys))
+
+
+# Keys rejected as invalid stay quarantined for the rest of the process
+INVALID_KEY_QUARANTINE_SECONDS = float("inf")
+
+
+class ApiKey:
+    """One pooled API key with its own service clients and quarantine state."""
+
+    def __init__(self, api_key, clients=None):
+        self.api_key = api_key
+        self.clients = clients or {}
+        self.label = f"key …{api_key[-4:]}"
+        self.quarantined_until = 0.0
+        self.quarantine_reason = ""
+
+    def quarantine(self, seconds, reason):
+        """Take the key out of rotation for ``seconds``."""
+        self.quarantined_until = max(self.quarantined_until, time.time() + seconds)
+        self.quarantine_reason = reason
+
+    def is_available(self):
+        return time.time() >= self.quarantined_until
+
+
+class ApiKeyPool:
+    """Several API keys whose quotas are pooled, each with its own clients.
+
+    Requests are spread over the keys by ModelRouter; every key gets its own route (and so
+    its own rate limiter and daily quota) per model, which lets throughput grow with the
+    number of keys. Keys rejected as invalid are quarantined.
+    """
+
+    def __init__(self, api_keys, client_factory=gemini_clients):
+        if not api_keys:
+            raise ValueError("At least one API key is required")
+        self.keys = [ApiKey(api_key, client_factory(api_key)) for api_key in api_keys]
+
+    def available_keys(self):
+        return [key for key in self.keys if key.is_available()]
+
+
+def create_prefixed_model(prefix, generation_config, model_name=MODEL_NAME, clients=None):
+    """Build a model that carries the static prompt prefix, so rows only send their suffix.
+
+    The prefix is uploaded once as Gemini cached content, kept as the model's ``prefix_cache``.
+    When it is below the model's minimum cacheable size, or context caching fails, it is
+    attached as the model's system instruction instead. With ``clients`` from
+    gemini_clients the model and its cached content use that key instead of the
+    process-global configuration.
+    """
+    import google.generativeai as genai
+    from google.api_core import exceptions as google_exceptions
+    clients = clients or {}
+    prefix_tokens = estimate_tokens(prefix)
+    cached_content = None
+    if prefix_tokens < MIN_CACHED_PREFIX_TOKENS.get(model_name, DEFAULT_MIN_CACHED_PREFIX_TOKENS):
+        logging.info(f"Prompt prefix of about {prefix_tokens} tokens is too short to cache for {model_name}")
+    else:
+        if "cache" in clients:
+            # CachedContent.create always uses the global client, so send its request ourselves
+            prepare_create_request = genai_private(genai.caching.CachedContent, '_prepare_create_request')
+            from_obj = genai_private(genai.caching.CachedContent, '_from_obj')
+        try:
+            cache_options = dict(model=model_name, display_name="itom-email-prefix", system_instruction=prefix,
+                                 ttl=PREFIX_CACHE_TTL_SECONDS)
+            if "cache" in clients:
+                cached_content = from_obj(
+                    clients["cache"].create_cached_content(prepare_create_request(**cache_options)))
+            else:
+                cached_content = genai.caching.CachedContent.create(**cache_options)
+        except google_exceptions.GoogleAPIError as e:
+            logging.info(f"Prompt prefix not cached ({e}); sending it as the system instruction")
+    if cached_content is not None:
+        model = genai.GenerativeModel.from_cached_content(cached_content, generation_config=generation_config)
+    else:
+        model = genai.GenerativeModel(
+            model_name=model_name,
+            generation_config=generation_config,
+            system_instruction=prefix
+        )
+    if "generative" in clients:
+        bind_model_client(model, clients["generative"])
+    model.prefix_cache = cached_content
+    # The prefix is billed with every request, whether cached or sent as the system instruction
+    model.prefix_tokens = prefix_tokens
+    return model
+
+
+def delete_prefix_cache(model, clients=None):
+    """Delete the cached content uploaded for a prefixed model, if any, instead of leaving it to expire."""
+    cached_content = getattr(model, "prefix_cache", None)
+    if cached_content is None:
+        return
+    from google.api_core import exceptions as google_exceptions
+    try:
+        if clients and "cache" in clients:
+            clients["cache"].delete_cached_content(name=cached_content.name)
+        else:
+            cached_content.delete()
+    except google_exceptions.GoogleAPIError as e:
+        logging.info(f"Cached prompt prefix {cached_content.name} not deleted ({e})")
+
+
+# Clients and models unused this long are dropped from the registry and their connections closed
+CLIENT_IDLE_SECONDS = 15 * 60
+# Prefixed models are rebuilt before their cached content expires on the server
+PREFIXED_MODEL_MAX_AGE_SECONDS = PREFIX_CACHE_TTL_SECONDS * 0.9
+
+
+class ClientRegistry:
+    """Process-wide registry of API clients and models, shared by every session.
+
+    Service clients are keyed by API key, so all sessions and threads using a key share
+    one kept-alive connection. Models are keyed by API key, model name, prompt prefix and
+    generation settings; a model is never changed after it is built, so other settings
+    simply map to another entry. Entries unused for ``idle_seconds`` are evicted, and the
+    cached prefix of an evicted or rebuilt model is deleted. Thread safe.
+    """
+
+    def __init__(self, idle_seconds=CLIENT_IDLE_SECONDS, client_factory=gemini_clients, clock=time.monotonic):
+        self.idle_seconds = idle_seconds
+        self.client_factory = client_factory
+        self.clock = clock
+        self._clients = {}
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def clients(self, api_key):
+        """Shared service clients of ``api_key``."""
+        with self._lock:
+            now = self.clock()
+            evicted = self._evict_idle(now)
+            entry = self._clients.get(api_key)
+            if entry is None:
+                entry = self._clients[api_key] = {"clients": self.client_factory(api_key), "last_used": now}
+            entry["last_used"] = now
+        # Deleting cached prefixes and closing connections are network calls, made outside the lock
+        self._release(*evicted)
+        return entry["clients"]
+
+    def model(self, api_key, model_name, generation_config, prefix=None):
+        """Shared model for these settings, carrying ``prefix`` when given."""
+        model_key = (api_key, model_name, json.dumps(generation_config, sort_keys=True),
+                     hashlib.sha256(prefix.encode("utf-8")).hexdigest() if prefix is not None else None)
+        clients = self.clients(api_key) if api_key else None
+        with self._lock:
+            now = self.clock()
+            entry = self._models.get(model_key)
+            if entry is not None and (prefix is None or now - entry["created"] < PREFIXED_MODEL_MAX_AGE_SECONDS):
+                entry["last_used"] = now
+                return entry["model"]
+
+        # Built outside the lock: uploading the prefix is a network round trip
+        generation_config = dict(generation_config)
+        if prefix is None:
+            import google.generativeai as genai
+            model = genai.GenerativeModel(model_name=model_name, generation_config=generation_config)
+            if clients:
+                bind_model_client(model, clients["generative"])
+        else:
+            model = create_prefixed_model(prefix, generation_config, model_name, clients)
+        built = {"model": model, "clients": clients}
+        with self._lock:
+            now = self.clock()
+            entry = self._models.get(model_key)
+            if entry is not None and (prefix is None or now - entry["created"] < PREFIXED_MODEL_MAX_AGE_SECONDS):
+                # Another thread built this model meanwhile; keep theirs and drop ours
+                entry["last_used"] = now
+                entry, built = built, entry
+            else:
+                built.update(created=now, last_used=now)
+                self._models[model_key] = built
+        if entry is not None:
+            self._release([entry], [])
+        return built["model"]
+
+    def _evict_idle(self, now):
+        """Drop entries unused for ``idle_seconds``, returning (model entries, client sets) to release."""
+        models = [self._models.pop(model_key) for model_key in
+                  [k for k, entry in self._models.items() if now - entry["last_used"] > self.idle_seconds]]
+        in_use = {model_key[0] for model_key in self._models}
+        clients = [self._clients.pop(api_key)["clients"] for api_key in
+                   [k for k, entry in self._clients.items()
+                    if now - entry["last_used"] > self.idle_seconds and k not in in_use]]
+        return models, clients
+
+    def _release(self, models, clients):
+        for entry in models:
+            delete_prefix_cache(entry["model"], entry["clients"])
+        for client_set in clients:
+            for client in client_set.values():
+                try:
+                    client.transport.close()
+                except Exception:
+                    pass
+
+    def __len__(self):
+        with self._lock:
+            return len(self._models)
+
+
+@st.cache_resource
+def get_client_registry():
+    """Return the process-wide client registry shared by all sessions."""
+    return ClientRegistry()
+
+
+def get_prefixed_model(prefix, model_name=MODEL_NAME, api_key=None):
+    """Return the shared model for this prefix and the session's generation settings."""
+    return get_client_registry().model(api_key.api_key if api_key else None, model_name,
+                                       st.session_state.generation_config, prefix)
+
+
+class FakeUsage:
+    """Token counts in the shape of a Gemini response's usage_metadata."""
+
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_tokens = prompt_token_count + candidates_token_count
+
+
+class FakeResponse:
+    """Minimal stand-in for a Gemini response."""
+
+    def __init__(self, text, prompt=""):
+        self.text = text
+        self.usage_metadata = FakeUsage(estimate_tokens(prompt), estimate_tokens(text))
+
+
+class FakeStreamResponse:
+    """Streamed version of a FakeResponse, delivered in small text chunks and cancellable."""
+
+    def __init__(self, response, chunk_size=40):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.cancelled = False
+        self.chunks_sent = 0
+
+    def __iter__(self):
+        text = self.response.text
+        for start in range(0, len(text), self.chunk_size):
+            if self.cancelled:
+                return
+            self.chunks_sent += 1
+            chunk = FakeResponse(text[start:start + self.chunk_size])
+            chunk.usage_metadata = self.response.usage_metadata
+            yield chunk
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeRateLimitError(Exception):
+    """Injected quota error, worded like the one the Gemini API raises."""
+
+
+# Extra per-call delay of the fake backend, drawn around the configured ``latency_jitter``
+FAKE_LATENCY_DISTRIBUTIONS = {
+    "uniform": lambda rng, spread: rng.uniform(0, spread),
+    "exponential": lambda rng, spread: rng.expovariate(1 / spread) if spread > 0 else 0.0,
+    "lognormal": lambda rng, spread: spread * rng.lognormvariate(0, 1) if spread > 0 else 0.0,
+}
+
+
+class FakeModel:
+    """Deterministic offline stand-in for GenerativeModel with configurable latency and error injection.
+
+    Each call sleeps ``latency`` plus an extra delay drawn from ``latency_distribution``
+    (uniform up to, or with mean/median ``latency_jitter`` seconds), then fails with a 429
+    with probability ``rate_limit_rate``, with a server error with probability ``error_rate``,
+    or returns three paragraphs built from the contact fields in the prompt. JSON-mode batch
+    requests get one entry per "Row ID" block, each left out with probability ``drop_rate``;
+    single-email and paragraph-rewrite JSON requests get an object in their schema's shape.
+    Each paragraph breaks a writing rule (placeholder text) with probability ``flaw_rate``.
+    Outcomes depend only on ``seed``, the prompt and how often that prompt was sent, so runs
+    are reproducible.
+    """
+
+    def __init__(self, latency=0.0, latency_jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, drop_rate=0.0,
+                 seed=0, system_instruction=None, sleep=time.sleep, latency_distribution="uniform",
+                 retry_after=1.0, model_name="fake-model", flaw_rate=0.0):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.latency_distribution = FAKE_LATENCY_DISTRIBUTIONS[latency_distribution]
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.drop_rate = drop_rate
+        self.flaw_rate = flaw_rate
+        self.seed = seed
+        self.system_instruction = system_instruction
+        self.prefix_tokens = estimate_tokens(system_instruction) if system_instruction else 0
+        self.sleep = sleep
+        self.model_name = model_name
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def _paragraphs(self, fields, rng):
+        paragraphs = [
+            f"{fields.get('First Name', 'there')}, as {fields.get('Role', 'an IT leader')} at "
+            f"{fields.get('Company', 'your company')}, you keep {fields.get('Industry', 'your')} operations in "
+            f"{fields.get('Country', 'your region')} running.",
+            "OpManager Plus gives you one view of your network, servers and applications.",
+            fields.get('Selected CTA', '') or "Would you be open to a quick demo this week?",
+        ]
+        return [f"{paragraph} See [Case Study Link]." if self.flaw_rate and rng.random() < self.flaw_rate else paragraph
+                for paragraph in paragraphs]
+
+    def count_tokens(self, contents):
+        return FakeUsage(estimate_tokens(str(contents)), 0)
+
+    def generate_content(self, contents, generation_config=None, stream=False, **kwargs):
+        if stream:
+            return FakeStreamResponse(self.generate_content(contents, generation_config))
+        prompt = contents if isinstance(contents, str) else str(contents)
+        with self._lock:
+            attempt = self._attempts.get(prompt, 0)
+            self._attempts[prompt] = attempt + 1
+        rng = random.Random(f"{self.seed}:{attempt}:{prompt}")
+
+        self.sleep(self.latency + self.latency_distribution(rng, self.latency_jitter))
+        if rng.random() < self.rate_limit_rate:
+            raise FakeRateLimitError(
+                f"429 Resource has been exhausted (e.g. check quota). Please retry in {self.retry_after}s."
+            )
+        if rng.random() < self.error_rate:
+            raise RuntimeError("500 An internal error has occurred (injected by FakeModel)")
+
+        generation_config = generation_config or {}
+        properties = generation_config.get("response_schema", {}).get("properties", {})
+        if generation_config.get("response_mime_type") == "application/json" and properties:
+            fields = dict(re.findall(r'^([A-Za-z ]+): (.*)$', prompt, re.MULTILINE))
+            paragraphs = self._paragraphs(fields, rng)
+            if "paragraph" in properties:
+                number = int(re.search(r'Rewrite only paragraph (\d)', prompt).group(1))
+                return FakeResponse(json.dumps({"paragraph": paragraphs[number - 1]}), prompt)
+            return FakeResponse(email_response_json(paragraphs), prompt)
+        if generation_config.get("response_mime_type") == "application/json":
+            shared = dict(re.findall(r'^(Selected CTA): (.*)$', prompt, re.MULTILINE))
+            items = []
+            for block in prompt.split("Row ID: ")[1:]:
+                fields = dict(shared, **dict(re.findall(r'^([A-Za-z ]+): (.*)$', block, re.MULTILINE)))
+                if rng.random() < self.drop_rate:
+                    continue
+                paragraphs = self._paragraphs(fields, rng)
+                items.append({"row_id": int(block.split("\n", 1)[0]), "paragraph1": paragraphs[0],
+                              "paragraph2": paragraphs[1], "paragraph3": paragraphs[2]})
+            return FakeResponse(json.dumps(items), prompt)
+
+        fields = dict(re.findall(r'^([A-Za-z ]+): (.*)$', prompt, re.MULTILINE))
+        return FakeResponse("\n\n".join(self._paragraphs(fields, rng)), prompt)
+
+
+def create_gemini_backend(prefix, generation_config, api_key=None, model_name=MODEL_NAME, clients=None):
+    """Gemini model carrying the prompt prefix, using its own clients for ``api_key`` when given."""
+    if clients is None and api_key:
+        clients = gemini_clients(api_key)
+    return create_prefixed_model(prefix, generation_config, model_name, clients)
+
+
+def create_fake_backend(prefix, generation_config, **options):
+    """Offline FakeModel; ``options`` are passed through to its constructor."""
+    return FakeModel(system_instruction=prefix, **options)
+
+
+# Model backends selectable from the command line
+MODEL_BACKENDS = {
+    "gemini": create_gemini_backend,
+    "fake": create_fake_backend,
+}
+
+
+# Default request budgets; override them in Advanced Model Settings to match your quota
+DEFAULT_RPM_LIMIT = 60
+DEFAULT_TPM_LIMIT = 1000000
+EXPECTED_OUTPUT_TOKENS = 400
+MAX_RATE_LIMIT_RETRIES = 5
+
+
+class SystemClock:
+    """Monotonic wall clock used by the rate limiter."""
+
+    def now(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class FakeClock:
+    """Clock that only moves when slept on or advanced, for testing the rate limiter offline."""
+
+    def __init__(self, start=0.0):
+        self.current = start
+        self.sleeps = []
+
+    def now(self):
+        return self.current
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        if seconds > 0:
+            self.current += seconds
+
+    def advance(self, seconds):
+        self.current += seconds
+
+
+class TokenBucket:
+    """Token bucket refilled continuously from a per-minute budget."""
+
+    def __init__(self, per_minute, burst_seconds, now):
+        self.per_minute = per_minute
+        self.capacity = max(1.0, per_minute * burst_seconds / 60.0)
+        self.tokens = self.capacity
+        self.updated = now
+
+    def refill(self, now, scale):
+        elapsed = max(0.0, now - self.updated)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.per_minute * scale / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount, scale):
+        """Seconds until ``amount`` can be taken; oversized requests only need a full bucket."""
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) * 60.0 / (self.per_minute * scale)
+
+    def consume(self, amount):
+        self.tokens -= amount
+
+
+class RateLimiter:
+    """Paces model calls under RPM/TPM budgets with AIMD back-off on rate-limit errors.
+
+    Requests and tokens are drawn from two token buckets. Every 429 halves the
+    effective rate and blocks all callers until the retry delay has passed; every
+    success recovers a small fraction of the rate. Thread safe, so one limiter can
+    be shared by all workers of a bulk run.
+    """
+
+    def __init__(self, rpm=DEFAULT_RPM_LIMIT, tpm=DEFAULT_TPM_LIMIT, clock=None, jitter=0.1,
+                 burst_seconds=1.0, min_scale=0.05, increase_step=0.05, base_backoff=2.0,
+                 max_backoff=60.0, rng=None):
+        self.clock = clock or SystemClock()
+        self.jitter = jitter
+        self.burst_seconds = burst_seconds
+        self.min_scale = min_scale
+        self.increase_step = increase_step
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.rng = rng or random.Random()
+        self.scale = 1.0
+        self.blocked_until = 0.0
+        self.consecutive_throttles = 0
+        self.throttle_count = 0
+        self._lock = threading.Lock()
+        self.configure(rpm, tpm)
+
+    def configure(self, rpm, tpm):
+        """Apply new RPM/TPM budgets, keeping the current back-off state."""
+        with self._lock:
+            now = self.clock.now()
+            self.rpm = rpm
+            self.tpm = tpm
+            self.request_bucket = TokenBucket(rpm, self.burst_seconds, now)
+            self.token_bucket = TokenBucket(tpm, self.burst_seconds, now)
+
+    def _wait_time(self, tokens, now):
+        self.request_bucket.refill(now, self.scale)
+        self.token_bucket.refill(now, self.scale)
+        return max(
+            self.blocked_until - now,
+            self.request_bucket.wait_time(1, self.scale),
+            self.token_bucket.wait_time(tokens, self.scale),
+        )
+
+    def acquire(self, tokens=0):
+        """Block until one request of ``tokens`` tokens fits the budget; returns seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                wait = self._wait_time(tokens, self.clock.now())
+                if wait <= 0:
+                    self.request_bucket.consume(1)
+                    self.token_bucket.consume(tokens)
+                    return waited
+            wait += self.rng.uniform(0, self.jitter * wait)
+            self.clock.sleep(wait)
+            waited += wait
+
+    def try_acquire(self, tokens=0):
+        """Take one request of ``tokens`` tokens only if it fits right now; returns whether it did."""
+        with self._lock:
+            if self._wait_time(tokens, self.clock.now()) > 0:
+                return False
+            self.request_bucket.consume(1)
+            self.token_bucket.consume(tokens)
+            return True
+
+    def wait_time(self, tokens=0):
+        """Seconds until one request of ``tokens`` tokens would fit, without taking it."""
+        with self._lock:
+            return max(0.0, self._wait_time(tokens, self.clock.now()))
+
+    def headroom(self):
+        """Share of the full budget available right now, from 0 (blocked or drained) to 1."""
+        with self._lock:
+            now = self.clock.now()
+            if now < self.blocked_until:
+                return 0.0
+            self.request_bucket.refill(now, self.scale)
+            self.token_bucket.refill(now, self.scale)
+            return self.scale * max(0.0, min(self.request_bucket.tokens / self.request_bucket.capacity,
+                                             self.token_bucket.tokens / self.token_bucket.capacity))
+
+    def on_success(self):
+        """Additively recover the request rate after a successful call."""
+        with self._lock:
+            self.consecutive_throttles = 0
+            self.scale = min(1.0, self.scale + self.increase_step)
+
+    def on_throttle(self, retry_after=None):
+        """Halve the request rate and pause every caller; returns the pause in seconds."""
+        with self._lock:
+            self.throttle_count += 1
+            self.consecutive_throttles += 1
+            self.scale = max(self.min_scale, self.scale / 2)
+            if retry_after is None:
+                retry_after = min(self.max_backoff,
+                                  self.base_backoff * 2 ** (self.consecutive_throttles - 1))
+            pause = retry_after + self.rng.uniform(0, self.jitter * retry_after)
+            now = self.clock.now()
+            self.blocked_until = max(self.blocked_until, now + pause)
+            return self.blocked_until - now
+
+
+def quota_day():
+    """Number of the current (UTC) day; daily quotas reset when it changes."""
+    return int(time.time() // 86400)
+
+
+def api_key_id(api_key):
+    """Short fingerprint of an API key, safe to store where the key itself must not be."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16] if api_key else ""
+
+
+class ModelRoute:
+    """One model (on one API key) of a ModelRouter, paced by its own rate limiter and daily request quota."""
+
+    def __init__(self, name, model, limiter, rpd=None, key=None):
+        self.name = name
+        self.model = model
+        self.limiter = limiter
+        self.rpd = rpd
+        self.key = key
+        self.requests_today = 0
+        self.exhausted_today = False
+        # Called with the route after each request, e.g. to persist the daily count
+        self.on_request = None
+        self._day = None
+        self._lock = threading.Lock()
+
+    def _roll_day(self):
+        day = quota_day()
+        if day != self._day:
+            self._day = day
+            self.requests_today = 0
+            self.exhausted_today = False
+
+    def has_daily_quota(self):
+        with self._lock:
+            self._roll_day()
+            return not self.exhausted_today and (self.rpd is None or self.requests_today < self.rpd)
+
+    @property
+    def prefix_tokens(self):
+        """Tokens of the prompt prefix the model sends along with every request."""
+        return getattr(self.model, 'prefix_tokens', 0)
+
+    def is_available(self):
+        return (self.key is None or self.key.is_available()) and self.has_daily_quota()
+
+    def headroom(self):
+        """Remaining share of this route's rate and daily budgets."""
+        headroom = self.limiter.headroom()
+        with self._lock:
+            if self.rpd:
+                headroom *= max(0.0, 1 - self.requests_today / self.rpd)
+        return headroom
+
+    def count_request(self):
+        with self._lock:
+            self._roll_day()
+            self.requests_today += 1
+        if self.on_request is not None:
+            self.on_request(self)
+
+    def restore_requests_today(self, count):
+        """Continue from ``count`` requests already sent today, e.g. by earlier jobs."""
+        with self._lock:
+            self._roll_day()
+            self.requests_today = count
+
+    def exhaust_for_today(self):
+        """Skip this route until tomorrow after the API reported its daily quota as used up."""
+        with self._lock:
+            self._roll_day()
+            self.exhausted_today = True
+
+
+class NoAvailableModelError(Exception):
+    """Raised when every model of a router is quarantined or out of daily quota."""
+
+
+class ModelRouter:
+    """Spreads requests over an ordered list of models, spilling over when one is saturated.
+
+    Each request goes to the first model whose limiter has room right now. A model that is
+    out of budget, out of daily quota or backing off after a 429 is skipped, so work moves
+    on to the next model instead of stalling; when every model is busy the request waits
+    for whichever frees up first. When a model is reachable through several API keys, the
+    key with the most remaining headroom is tried first; quarantined keys are skipped.
+    """
+
+    def __init__(self, routes):
+        if not routes:
+            raise ValueError("A model router needs at least one model")
+        self.routes = list(routes)
+
+    @property
+    def model_names(self):
+        return list(dict.fromkeys(route.name for route in self.routes))
+
+    def available_routes(self):
+        return [route for route in self.routes if route.is_available()]
+
+    def acquire(self, tokens=0):
+        """Reserve one request on the best available model; returns (route, seconds waited).
+
+        ``tokens`` is the per-request part of the cost; each model's prompt prefix is added on top.
+        Raises NoAvailableModelError rather than resending on rejected keys or used-up quotas.
+        """
+        routes = self.available_routes()
+        if not routes:
+            raise NoAvailableModelError("No model is available: every API key was rejected or "
+                                        "has used up its daily quota.")
+        limiter = routes[0].limiter
+        model_rank = {name: rank for rank, name in enumerate(self.model_names)}
+        waited = 0.0
+        while True:
+            ranked = sorted(routes, key=lambda route: (model_rank[route.name], -route.headroom()))
+            for route in ranked:
+                if route.limiter.try_acquire(tokens + route.prefix_tokens):
+                    route.count_request()
+                    return route, waited
+            wait = min(route.limiter.wait_time(tokens + route.prefix_tokens) for route in routes)
+            wait += limiter.rng.uniform(0, limiter.jitter * wait)
+            limiter.clock.sleep(wait)
+            waited += wait
+
+
+def model_display_name(model):
+    """Model name without the API's "models/" resource prefix."""
+    name = getattr(model, 'model_name', None) or MODEL_NAME
+    return name[len("models/"):] if name.startswith("models/") else name
+
+
+def as_router(model, limiter=None):
+    """Wrap a single model and its limiter as a one-model router; routers are returned as is."""
+    if isinstance(model, ModelRouter):
+        return model
+    return ModelRouter([ModelRoute(model_display_name(model), model, limiter or RateLimiter())])
+
+
+def get_model_router(prefix, model_names, model_limits=None):
+    """Return a router over the session's prefixed models on every pooled API key.
+
+    Each (model, key) pair keeps its limiter across reruns, since quotas are tracked per key
+    and model; daily counts are shared with bulk jobs through the job store.
+    """
+    if model_limits is None:
+        model_limits = MODEL_LIMITS
+    if 'model_routes' not in st.session_state:
+        st.session_state.model_routes = {}
+    key_pool = st.session_state.get('key_pool')
+    keys = key_pool.keys if key_pool is not None else [None]
+    job_store = get_job_store()
+    routes = []
+    for name in model_names:
+        limits = model_limits.get(name, {"rpm": DEFAULT_RPM_LIMIT, "tpm": DEFAULT_TPM_LIMIT, "rpd": DEFAULT_RPD_LIMIT})
+        for key in keys:
+            route_key = (name, key.api_key if key else None)
+            route = st.session_state.model_routes.get(route_key)
+            if route is None:
+                route = ModelRoute(name, None, RateLimiter(limits["rpm"], limits["tpm"]), key=key)
+                st.session_state.model_routes[route_key] = route
+            elif (route.limiter.rpm, route.limiter.tpm) != (limits["rpm"], limits["tpm"]):
+                route.limiter.configure(limits["rpm"], limits["tpm"])
+            route.rpd = limits["rpd"]
+            route.model = get_prefixed_model(prefix, name, key)
+            # Bulk jobs count against the same daily quotas
+            key_id = api_key_id(route_key[1])
+            route.restore_requests_today(job_store.requests_today(key_id, name))
+            route.on_request = lambda route, key_id=key_id: job_store.count_request(key_id, route.name)
+            routes.append(route)
+    return ModelRouter(routes)
+
+
+def estimate_tokens(text):
+    """Rough token count for budgeting (about four characters per token)."""
+    return len(text) // 4 + 1
+
+
+def is_invalid_key_error(error):
+    """Check whether an API error means the API key itself was rejected."""
+    error_message = str(error)
+    return ("API_KEY_INVALID" in error_message or "API key not valid" in error_message
+            or type(error).__name__ in ("Unauthenticated", "PermissionDenied"))
+
+
+def is_daily_quota_error(error):
+    """Check whether a rate-limit error reports a used-up daily quota rather than a per-minute one."""
+    return "PerDay" in str(error)
+
+
+def is_rate_limit_error(error):
+    """Check whether an API error means we were throttled."""
+    error_message = str(error)
+    return ("429" in error_message or "quota" in error_message.lower()
+            or type(error).__name__ == "ResourceExhausted")
+
+
+def parse_retry_delay(error):
+    """Extract the server's retry-after hint in seconds from an API error, if any."""
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is not None:
+        return float(retry_after)
+    error_message = str(error)
+    match = (re.search(r'retry_delay\s*\{\s*seconds:\s*(\d+)', error_message)
+             or re.search(r'retry in ([\d.]+)\s*s', error_message, re.IGNORECASE)
+             or re.search(r'retry-after:?\s*([\d.]+)', error_message, re.IGNORECASE))
+    if match:
+        return float(match.group(1))
+    return None
+
+
+# Per-request telemetry; the most recent records are kept for the JSON export
+TELEMETRY_MAX_RECORDS = 10000
+TELEMETRY_RATE_WINDOW_SECONDS = 60
+
+
+class Telemetry:
+    """Thread-safe collector of per-request model call metrics and bulk run progress.
+
+    Every model call (or response cache hit) is recorded with its wall time, rate-limiter
+    queue wait, prompt/output tokens, retries and error class. Totals feed the live
+    metrics panel and the Prometheus/JSON exports.
+    """
+
+    def __init__(self, max_records=TELEMETRY_MAX_RECORDS, clock=time.time):
+        self.clock = clock
+        self.records = deque(maxlen=max_records)
+        self.totals = {
+            "requests": 0, "errors": 0, "cache_hits": 0, "retries": 0, "prompt_tokens": 0,
+            "output_tokens": 0, "wall_seconds": 0.0, "queue_wait_seconds": 0.0, "rows_completed": 0,
+        }
+        self.errors_by_class = {}
+        self.run_started = None
+        self.run_total_rows = 0
+        self.run_rows_completed = 0
+        self._row_times = deque()
+        self._token_times = deque()
+        self._lock = threading.Lock()
+
+    def record_request(self, wall_seconds, queue_wait_seconds=0.0, prompt_tokens=0, output_tokens=0,
+                       retries=0, cache_hit=False, error_class=None, model_name=None):
+        """Record one model call, or one response served from the cache."""
+        now = self.clock()
+        record = {
+            "timestamp": now, "wall_seconds": wall_seconds, "queue_wait_seconds": queue_wait_seconds,
+            "prompt_tokens": prompt_tokens, "output_tokens": output_tokens, "retries": retries,
+            "cache_hit": cache_hit, "error_class": error_class, "model": model_name,
+        }
+        with self._lock:
+            self.records.append(record)
+            if cache_hit:
+                self.totals["cache_hits"] += 1
+            else:
+                self.totals["requests"] += 1
+            if error_class:
+                self.totals["errors"] += 1
+                self.errors_by_class[error_class] = self.errors_by_class.get(error_class, 0) + 1
+            self.totals["retries"] += retries
+            self.totals["prompt_tokens"] += prompt_tokens
+            self.totals["output_tokens"] += output_tokens
+            if not cache_hit:
+                self.totals["wall_seconds"] += wall_seconds
+                self.totals["queue_wait_seconds"] += queue_wait_seconds
+            if prompt_tokens or output_tokens:
+                self._token_times.append((now, prompt_tokens + output_tokens))
+
+    def start_run(self, total_rows, rows_completed=0):
+        """Reset the progress counters used for rows/min and ETA."""
+        with self._lock:
+            self.run_started = self.clock()
+            self.run_total_rows = total_rows
+            self.run_rows_completed = rows_completed
+            self._row_times.clear()
+
+    def rows_done(self, count=1):
+        now = self.clock()
+        with self._lock:
+            self.totals["rows_completed"] += count
+            self.run_rows_completed += count
+            self._row_times.append((now, count))
+
+    def summary(self):
+        """Totals plus rows/min, tokens/min over the last minute and the ETA of the current run."""
+        now = self.clock()
+        with self._lock:
+            for times in (self._row_times, self._token_times):
+                while times and now - times[0][0] > TELEMETRY_RATE_WINDOW_SECONDS:
+                    times.popleft()
+            window = TELEMETRY_RATE_WINDOW_SECONDS
+            if self.run_started is not None:
+                window = min(window, max(now - self.run_started, 1e-6))
+            rows_per_minute = sum(count for _, count in self._row_times) * 60 / window
+            tokens_per_minute = sum(count for _, count in self._token_times) * 60 / window
+            remaining_rows = max(0, self.run_total_rows - self.run_rows_completed)
+            eta_seconds = remaining_rows * 60 / rows_per_minute if rows_per_minute else None
+            calls = max(self.totals["requests"], 1)
+            return dict(
+                self.totals,
+                errors_by_class=dict(self.errors_by_class),
+                rows_per_minute=rows_per_minute,
+                tokens_per_minute=tokens_per_minute,
+                eta_seconds=eta_seconds if remaining_rows else 0.0,
+                run_total_rows=self.run_total_rows,
+                run_rows_completed=self.run_rows_completed,
+                avg_request_seconds=self.totals["wall_seconds"] / calls,
+                avg_queue_wait_seconds=self.totals["queue_wait_seconds"] / calls,
+            )
+
+    def to_json(self, recent=100):
+        """Summary and the most recent request records as JSON."""
+        summary = self.summary()
+        with self._lock:
+            records = list(self.records)[-recent:]
+        return json.dumps({"summary": summary, "recent_requests": records}, indent=2)
+
+    def to_prometheus(self):
+        """Summary in the Prometheus text exposition format."""
+        summary = self.summary()
+        lines = []
+
+        def metric(name, metric_type, help_text, value, labels=None):
+            if not any(line.startswith(f"# TYPE {name} ") for line in lines):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+            label_text = "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}" if labels else ""
+            lines.append(f"{name}{label_text} {value}")
+
+        metric("itom_model_requests_total", "counter", "Model calls made.", summary["requests"])
+        metric("itom_cache_hits_total", "counter", "Responses served from the response cache.",
+               summary["cache_hits"])
+        for error_class, count in sorted(summary["errors_by_class"].items()):
+            metric("itom_model_errors_total", "counter", "Failed model calls by error class.", count,
+                   {"error_class": error_class})
+        metric("itom_model_retries_total", "counter", "Rate-limit retries.", summary["retries"])
+        metric("itom_prompt_tokens_total", "counter", "Prompt tokens sent.", summary["prompt_tokens"])
+        metric("itom_output_tokens_total", "counter", "Output tokens received.", summary["output_tokens"])
+        metric("itom_request_seconds_sum", "counter", "Wall time spent in model calls.", summary["wall_seconds"])
+        metric("itom_queue_wait_seconds_sum", "counter", "Time spent waiting on the rate limiter.",
+               summary["queue_wait_seconds"])
+        metric("itom_rows_completed_total", "counter", "Contacts with a finished email.", summary["rows_completed"])
+        metric("itom_rows_per_minute", "gauge", "Recent row throughput.", summary["rows_per_minute"])
+        metric("itom_tokens_per_minute", "gauge", "Recent token throughput.", summary["tokens_per_minute"])
+        if summary["eta_seconds"] is not None:
+            metric("itom_run_eta_seconds", "gauge", "Estimated time left in the current run.",
+                   summary["eta_seconds"])
+        return "\n".join(lines) + "\n"
+
+
+def format_run_metrics(summary):
+    """One-line live status of a bulk run."""
+    eta = summary["eta_seconds"]
+    eta_text = "–" if eta is None else f"{int(eta // 60)}m {int(eta % 60):02d}s"
+    return (f"⏱️ {summary['run_rows_completed']}/{summary['run_total_rows']} rows · "
+            f"{summary['rows_per_minute']:.1f} rows/min · {summary['tokens_per_minute']:,.0f} tokens/min · "
+            f"ETA {eta_text} · {summary['retries']} retries · {summary['cache_hits']} cache hits · "
+            f"avg call {summary['avg_request_seconds']:.1f}s (queue {summary['avg_queue_wait_seconds']:.1f}s)")
+
+
+def response_token_usage(response):
+    """(prompt_tokens, output_tokens) reported by the API, or zeros when unavailable."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return 0, 0
+    return (getattr(usage, 'prompt_token_count', 0) or 0), (getattr(usage, 'candidates_token_count', 0) or 0)
+
+
+# Messages of the generation code; the CLI prints them, job workers keep them in the log
+generation_logger = logging.getLogger("itom.generation")
+NOTIFY_LOG_LEVELS = {"info": logging.INFO, "warning": logging.WARNING, "error": logging.ERROR}
+
+
+def notify(level, message):
+    """Show ``message`` on the page during a script run, otherwise log it (CLI, benchmarks, job workers)."""
+    if get_script_run_ctx(suppress_warning=True) is not None:
+        getattr(st, level)(message)
+    else:
+        generation_logger.log(NOTIFY_LOG_LEVELS[level], message)
+
+
+def print_generation_messages(stream=None):
+    """Print the generation code's rate-limit and error messages to ``stream`` (stderr by default)."""
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+    generation_logger.addHandler(handler)
+
+
+def rate_limit_warning(router, route, pause):
+    """Tell the user a model is throttled and where the retry goes."""
+    if len(router.routes) > 1:
+        notify("warning", f"Rate limit hit on {route.name}. Spilling over to the next available model...")
+    else:
+        notify("warning", f"Rate limit hit. Slowing down and retrying in {pause:.0f} seconds...")
+
+
+def take_route_out_of_rotation(router, route, error):
+    """Quarantine a rejected key or a used-up daily quota; returns whether another route can retry."""
+    if is_invalid_key_error(error) and route.key is not None:
+        route.key.quarantine(INVALID_KEY_QUARANTINE_SECONDS, "invalid")
+        notify("warning", f"API {route.key.label} was rejected and has been taken out of the key pool.")
+    elif is_rate_limit_error(error) and is_daily_quota_error(error):
+        route.exhaust_for_today()
+    else:
+        return False
+    return bool(router.available_routes())
+
+
+def generate_email_content(prompt, model=None, limiter=None, generation_config=None,
+                           expected_output_tokens=EXPECTED_OUTPUT_TOKENS, telemetry=None, return_model=False):
+    """Generate email content using Gemini model with rate limit handling.
 
-    while retry_count < max_retries:
+    ``model`` may be a ModelRouter: every attempt then goes to the first model with spare
+    capacity, so a 429 moves the retry to the next model. With ``return_model`` the result
+    is (text, name of the model that answered).
+    """
+    if model is None:
+        model = st.session_state.model
+    router = as_router(model, limiter)
+    request_tokens = estimate_tokens(prompt) + expected_output_tokens
+    request_options = {} if generation_config is None else {"generation_config": generation_config}
+    max_retries = MAX_RATE_LIMIT_RETRIES + len(router.routes) - 1
+    started = time.perf_counter()
+    queue_wait = 0.0
+    route = None
+
+    def record(response=None, error=None, retries=0):
+        if telemetry is not None:
+            prompt_tokens, output_tokens = response_token_usage(response)
+            telemetry.record_request(time.perf_counter() - started, queue_wait, prompt_tokens, output_tokens,
+                                     retries, error_class=type(error).__name__ if error else None,
+                                     model_name=route.name)
+
+    def result(text):
+        return (text, route.name if route else "") if return_model else text
+
+    for attempt in range(max_retries + 1):
+        try:
+            route, waited = router.acquire(request_tokens)
+        except NoAvailableModelError as e:
+            notify("error", str(e))
+            return result(f"Error: {e}")
+        queue_wait += waited
         try:
-            response = st.session_state.model.generate_content(prompt)
-            return response.text
+            response = route.model.generate_content(prompt, **request_options)
+            route.limiter.on_success()
+            record(response, retries=attempt)
+            return result(response.text)
         except Exception as e:
             error_message = str(e)
-            if "429" in error_message or "quota" in error_message.lower():
-                st.warning(f"Rate limit hit. Waiting for {delay} seconds before retrying...")
-                time.sleep(delay)
-                retry_count += 1
-                delay *= 2  # exponential backoff
+            if take_route_out_of_rotation(router, route, e):
+                continue
+            if is_rate_limit_error(e):
+                pause = route.limiter.on_throttle(parse_retry_delay(e))
+                if attempt < max_retries:
+                    rate_limit_warning(router, route, pause)
+                else:
+                    record(error=e, retries=attempt)
             else:
-                st.error(f"Error generating content: {error_message}")
-                return f"Error: {error_message}"
+                record(error=e, retries=attempt)
+                notify("error", f"Error generating content: {error_message}")
+                return result(f"Error: {error_message}")
+
+    notify("error", "Max retries exceeded due to rate limits.")
+    return result("Error: Too many requests. Please try again later or check your quota.")
+
+
+class ParagraphStreamParser:
+    """Split streamed text into clean paragraphs as they complete, like parse_email_paragraphs."""
+
+    def __init__(self):
+        self.buffer = ""
+        self.started = False
+        self.paragraphs = []
+
+    def feed(self, text):
+        """Add a chunk of text and return the paragraphs it completed."""
+        self.buffer += text
+        if not self.started:
+            self.buffer = self.buffer.lstrip()
+            self.started = bool(self.buffer)
+        completed = []
+        while '\n\n' in self.buffer:
+            paragraph, self.buffer = self.buffer.split('\n\n', 1)
+            if is_clean_paragraph(paragraph):
+                completed.append(paragraph)
+        self.paragraphs.extend(completed)
+        return completed
+
+    def finish(self):
+        """Flush the last paragraph once the stream has ended."""
+        paragraph, self.buffer = self.buffer.rstrip(), ""
+        if is_clean_paragraph(paragraph):
+            self.paragraphs.append(paragraph)
+            return [paragraph]
+        return []
+
+
+def cancel_stream(response):
+    """Stop a streaming response so the server stops generating text we would discard."""
+    cancel = getattr(response, 'cancel', None)
+    if not callable(cancel):
+        # GenerateContentResponse keeps the underlying gRPC stream in _iterator
+        cancel = getattr(genai_private(response, '_iterator'), 'cancel', None)
+    if callable(cancel):
+        cancel()
+        return True
+    return False
 
-    st.error("Max retries exceeded due to rate limits.")
-    return "Error: Too many requests. Please try again later or check your quota."
 
+def stream_email_paragraphs(prompt, model=None, limiter=None, telemetry=None, max_paragraphs=3, on_model=None):
+    """Stream an email from the model, yielding each clean paragraph as soon as it is complete.
 
-def generate_bulk_emails(df, cta_text, custom_text):
-    """Generate personalized emails for multiple recipients and add paragraphs as new columns."""
-    df = df.copy()
-    df['Paragraph1'] = ""
-    df['Paragraph2'] = ""
-    df['Paragraph3'] = ""
+    The stream is cancelled as soon as ``max_paragraphs`` paragraphs exist, so nothing past
+    the third paragraph is waited for. Rate limits are retried like generate_email_content
+    as long as no text has been received yet. ``on_model`` is called with the name of the
+    model that answers.
+    """
+    if model is None:
+        model = st.session_state.model
+    router = as_router(model, limiter)
+    max_retries = MAX_RATE_LIMIT_RETRIES + len(router.routes) - 1
+    started = time.perf_counter()
+    queue_wait = 0.0
+    route = None
+
+    def record(last_chunk=None, error=None, retries=0):
+        if telemetry is not None:
+            prompt_tokens, output_tokens = response_token_usage(last_chunk)
+            telemetry.record_request(time.perf_counter() - started, queue_wait, prompt_tokens, output_tokens,
+                                     retries, error_class=type(error).__name__ if error else None,
+                                     model_name=route.name)
+
+    for attempt in range(max_retries + 1):
+        try:
+            route, waited = router.acquire(estimate_tokens(prompt) + EXPECTED_OUTPUT_TOKENS)
+        except NoAvailableModelError as e:
+            notify("error", str(e))
+            return
+        queue_wait += waited
+        parser = ParagraphStreamParser()
+        last_chunk = None
+        yielded = 0
+        try:
+            response = route.model.generate_content(prompt, stream=True)
+            for chunk in response:
+                last_chunk = chunk
+                for paragraph in parser.feed(chunk.text):
+                    if yielded < max_paragraphs:
+                        yielded += 1
+                        yield paragraph
+                if yielded >= max_paragraphs:
+                    cancel_stream(response)
+                    break
+            else:
+                for paragraph in parser.finish():
+                    if yielded < max_paragraphs:
+                        yielded += 1
+                        yield paragraph
+            route.limiter.on_success()
+            record(last_chunk, retries=attempt)
+            if on_model is not None:
+                on_model(route.name)
+            return
+        except Exception as e:
+            if last_chunk is None and take_route_out_of_rotation(router, route, e):
+                continue
+            if is_rate_limit_error(e) and last_chunk is None:
+                pause = route.limiter.on_throttle(parse_retry_delay(e))
+                if attempt < max_retries:
+                    rate_limit_warning(router, route, pause)
+                else:
+                    record(error=e, retries=attempt)
+            else:
+                record(last_chunk, error=e, retries=attempt)
+                notify("error", f"Error generating content: {str(e)}")
+                return
+
+    notify("error", "Max retries exceeded due to rate limits.")
 
-    progress_bar = st.progress(0)
-    total_rows = len(df)
 
-    for idx, row in df.iterrows():
-        prompt = st.session_state.template.format(
-            first_name=row['First Name'],
-            last_name=row['Last Name'],
-            company=row['Company'],
-            role=row['Role'],
-            industry=row['Industry'],
-            country=row['Country'],
-            product_description=ITOM['description'],
-            product_features=", ".join(ITOM['features']),
-            cta=cta_text,
-            custom_text=custom_text
+# Several contacts can share one request; the model answers with JSON keyed by row ID
+MAX_BATCH_SIZE = 25
+MAX_BATCH_REQUEUES = 2
+
+BATCH_PROMPT_TEMPLATE = """Incorporate this custom context: {custom_text}
+
+Selected CTA: {cta}
+
+Write a separate email for each of the {count} recipients below. Return a JSON array with exactly one object per recipient, containing its Row ID as "row_id" and the three paragraphs as "paragraph1", "paragraph2" and "paragraph3".
+
+{recipients}
+"""
+
+BATCH_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "row_id": {"type": "integer"},
+            "paragraph1": {"type": "string"},
+            "paragraph2": {"type": "string"},
+            "paragraph3": {"type": "string"},
+        },
+        "required": ["row_id", "paragraph1", "paragraph2", "paragraph3"],
+    },
+}
+
+BATCH_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": BATCH_RESPONSE_SCHEMA,
+}
+
+
+def build_batch_prompt(leads_by_id, cta_text, custom_text, row_template=None):
+    """Render one request covering several contacts, each tagged with its row ID."""
+    if row_template is None:
+        row_template = st.session_state.row_template
+    # Reuse the contact block of the row template so batched and single prompts describe leads alike
+    contact_block = row_template[row_template.index("First Name:"):row_template.index("Selected CTA:")].strip()
+    recipients = "\n\n".join(
+        f"Row ID: {row_id}\n" + contact_block.format(
+            first_name=lead['First Name'],
+            last_name=lead['Last Name'],
+            company=lead['Company'],
+            role=lead['Role'],
+            industry=lead['Industry'],
+            country=lead['Country']
         )
+        for row_id, lead in leads_by_id.items()
+    )
+    return BATCH_PROMPT_TEMPLATE.format(custom_text=custom_text, cta=cta_text, count=len(leads_by_id),
+                                        recipients=recipients)
 
+
+def parse_batch_response(response_text, row_ids):
+    """Split a JSON batch response into {row_id: [paragraph1, paragraph2, paragraph3]}.
+
+    Entries for unknown row IDs or without three non-empty paragraphs are dropped, so
+    their rows show up as missing and can be re-queued.
+    """
+    text = response_text.strip()
+    # Tolerate a fenced ```json block in case the model ignores the response MIME type
+    text = re.sub(r'^```(?:json)?\s*|\s*```$', '', text)
+    try:
+        items = json.loads(text)
+    except ValueError:
+        return {}
+    if isinstance(items, dict):
+        items = next((value for value in items.values() if isinstance(value, list)), [items])
+    if not isinstance(items, list):
+        return {}
+
+    paragraphs_by_id = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
         try:
-            response = generate_email_content(prompt)
-            paragraphs = parse_email_paragraphs(response)
-            df.at[idx, 'Paragraph1'] = paragraphs[0]
-            df.at[idx, 'Paragraph2'] = paragraphs[1]
-            df.at[idx, 'Paragraph3'] = paragraphs[2]
-        except Exception as e:
-            st.error(f"Error generating email for {row['First Name']} {row['Last Name']}: {str(e)}")
-            df.at[idx, 'Paragraph1'] = f"Error: {str(e)}"
+            row_id = int(item.get("row_id"))
+        except (TypeError, ValueError):
+            continue
+        paragraphs = [str(item.get(f"paragraph{i}") or "").strip() for i in range(1, 4)]
+        if row_id in row_ids and all(paragraphs):
+            paragraphs_by_id[row_id] = paragraphs
+    return paragraphs_by_id
+
+
+def generate_batch_paragraphs(leads_by_id, cta_text, custom_text, model, limiter, row_template=None,
+                              max_requeues=MAX_BATCH_REQUEUES, telemetry=None):
+    """Generate emails for several contacts per request, re-queueing the ones the response missed.
+
+    Returns {row_id: (paragraphs, model name)} for every row that was answered; rows still
+    missing after ``max_requeues`` extra requests are left out for the caller to generate
+    one by one.
+    """
+    results = {}
+    remaining = dict(leads_by_id)
+    for attempt in range(max_requeues + 1):
+        if not remaining:
+            break
+        prompt = build_batch_prompt(remaining, cta_text, custom_text, row_template)
+        response, model_name = generate_email_content(prompt, model, limiter, BATCH_GENERATION_CONFIG,
+                                                      EXPECTED_OUTPUT_TOKENS * len(remaining), telemetry,
+                                                      return_model=True)
+        answered = parse_batch_response(response, set(remaining))
+        results.update({row_id: (paragraphs, model_name) for row_id, paragraphs in answered.items()})
+        remaining = {row_id: lead for row_id, lead in remaining.items() if row_id not in answered}
+    return results
+
+
+# Generated responses are cached on disk so unchanged rows are not sent to the model again
+RESPONSE_CACHE_PATH = "response_cache.sqlite3"
+RESPONSE_CACHE_MAX_ENTRIES = 50000
+RESPONSE_CACHE_MAX_AGE_SECONDS = 7 * 24 * 3600
+RESPONSE_CACHE_EVICT_EVERY = 100
+
+
+# Job workers share the cache and job databases with the UI process
+SQLITE_TIMEOUT_SECONDS = 30
+
+
+def connect_sqlite(path):
+    """Connection usable from any thread that waits on other processes' writes instead of failing."""
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=SQLITE_TIMEOUT_SECONDS)
+    # WAL lets the UI poll progress while a worker process is writing
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def add_missing_column(conn, table, column, definition):
+    """Add a column introduced after ``table`` was first created."""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+class ResponseCache:
+    """SQLite cache of model responses keyed by a hash of the rendered prompt, model and generation config.
 
-        progress_bar.progress((idx + 1) / total_rows)
+    Entries older than ``max_age_seconds`` are treated as misses and purged; beyond
+    ``max_entries`` the least recently used entries are evicted. Thread safe.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 max_age_seconds=RESPONSE_CACHE_MAX_AGE_SECONDS):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._puts_since_evict = 0
+        self._lock = threading.Lock()
+        self._conn = connect_sqlite(path)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL, "
+                "model TEXT NOT NULL DEFAULT '')"
+            )
+            add_missing_column(self._conn, "responses", "model", "TEXT NOT NULL DEFAULT ''")
+            self._evict()
+
+    def lookup(self, key):
+        """Return (response, model name) cached for ``key``, or None on a miss."""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT response, created_at, model FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.max_age_seconds:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0], row[2]
+
+    def get(self, key):
+        """Return the cached response for ``key``, or None on a miss."""
+        cached = self.lookup(key)
+        return None if cached is None else cached[0]
+
+    def put(self, key, response, model=""):
+        """Store a response and the model that wrote it, evicting stale or excess entries every few writes."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, last_used, model) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, response, now, now, model)
+            )
+            self._puts_since_evict += 1
+            if self._puts_since_evict >= RESPONSE_CACHE_EVICT_EVERY:
+                self._evict()
+
+    def _evict(self):
+        self._puts_since_evict = 0
+        self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age_seconds,))
+        self._conn.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def clear(self):
+        """Drop every cached response."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+@st.cache_resource
+def get_response_cache():
+    """Return the process-wide response cache shared by all sessions."""
+    return ResponseCache()
 
-    return df
+
+def response_cache_namespace(prefix, generation_config, model_names=None):
+    """Hash the parts of a request that are shared by every row of a run, including the allowed models."""
+    models = ",".join(sorted(model_names)) if model_names else MODEL_NAME
+    payload = json.dumps([models, prefix, generation_config], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def response_cache_key(namespace, prompt):
+    """Content address of a single rendered request."""
+    return hashlib.sha256(f"{namespace}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+def generate_cached_email_content(prompt, model, limiter, cache=None, namespace="", telemetry=None,
+                                  return_model=False, generation_config=None):
+    """Return a cached response for the prompt, generating and storing it on a miss.
+
+    With ``return_model`` the result is (text, name of the model that wrote it).
+    """
+    if cache is None:
+        return generate_email_content(prompt, model, limiter, generation_config, telemetry=telemetry,
+                                      return_model=return_model)
+
+    started = time.perf_counter()
+    key = response_cache_key(namespace, prompt)
+    cached = cache.lookup(key)
+    if cached is not None:
+        if telemetry is not None:
+            telemetry.record_request(time.perf_counter() - started, cache_hit=True)
+        response, model_name = cached
+    else:
+        response, model_name = generate_email_content(prompt, model, limiter, generation_config,
+                                                      telemetry=telemetry, return_model=True)
+        # Failures come back as "Error: ..." text and must be retried next run
+        if not response.startswith("Error:"):
+            cache.put(key, response, model_name)
+    return (response, model_name) if return_model else response
+
+
+MAX_REPAIR_ATTEMPTS = 2
+
+REPAIR_PROMPT_TEMPLATE = """{row_prompt}
+A previous draft of this email broke the writing rules: {issues}.
+
+Draft:
+Paragraph 1: {paragraph1}
+Paragraph 2: {paragraph2}
+Paragraph 3: {paragraph3}
+
+Rewrite only paragraph {number} so that it follows all the rules and still fits between the other paragraphs. Return it as JSON with the new text as "paragraph".
+"""
+
+PARAGRAPH_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {"paragraph": {"type": "string"}},
+        "required": ["paragraph"],
+    },
+}
+
+
+def parse_paragraph_response(response_text):
+    """Return the text of a JSON paragraph rewrite, or "" when the response is not one."""
+    text = re.sub(r'^```(?:json)?\s*|\s*```$', '', response_text.strip())
+    try:
+        item = json.loads(text)
+    except ValueError:
+        return ""
+    return str(item.get("paragraph") or "").strip() if isinstance(item, dict) else ""
+
+
+def repair_email_paragraphs(prompt, paragraphs, model_name, model, rules, telemetry=None,
+                            max_repairs=MAX_REPAIR_ATTEMPTS):
+    """Check a generated email against ``rules`` and regenerate only what breaks them.
+
+    Each round rewrites just the failing paragraphs, or the whole email when all three
+    fail, and at most ``max_repairs`` rounds are spent on a row. Returns
+    (paragraphs, model name, quality), where quality records the verdict ("passed",
+    "repaired", "failed" or "error"), the repair requests made, the rules broken before
+    repair and the violations left.
+    """
+    if paragraphs[0].startswith("Error:"):
+        return paragraphs, model_name, {"status": "error", "repairs": 0, "found": [], "issues": []}
+    issues = validate_email_paragraphs(paragraphs, rules)
+    found = sorted({rule for _, rule in issues})
+    repairs = 0
+    for _ in range(max_repairs):
+        if not issues:
+            break
+        failing = sorted({index for index, _ in issues})
+        if len(failing) == len(paragraphs):
+            response, answered_by = generate_email_content(prompt, model, None, EMAIL_GENERATION_CONFIG,
+                                                           telemetry=telemetry, return_model=True)
+            repairs += 1
+            if response.startswith("Error:"):
+                break
+            paragraphs, model_name = parse_email_response(response), answered_by
+        else:
+            paragraphs = list(paragraphs)
+            for index in failing:
+                repair_prompt = REPAIR_PROMPT_TEMPLATE.format(
+                    row_prompt=prompt, number=index + 1,
+                    issues=format_quality_issues([issue for issue in issues if issue[0] == index]),
+                    paragraph1=paragraphs[0], paragraph2=paragraphs[1], paragraph3=paragraphs[2]
+                )
+                response = generate_email_content(repair_prompt, model, None, PARAGRAPH_GENERATION_CONFIG,
+                                                  EXPECTED_OUTPUT_TOKENS // 3, telemetry)
+                repairs += 1
+                paragraphs[index] = parse_paragraph_response(response) or paragraphs[index]
+        issues = validate_email_paragraphs(paragraphs, rules)
+
+    status = "failed" if issues else ("repaired" if repairs else "passed")
+    return paragraphs, model_name, {"status": status, "repairs": repairs, "found": found, "issues": issues}
+
+
+def generate_checked_email(prompt, model, rules, cache=None, namespace="", telemetry=None,
+                           max_repairs=MAX_REPAIR_ATTEMPTS):
+    """Generate one email as schema-checked JSON, repairing rule violations with repair_email_paragraphs.
+
+    A repaired email replaces the cached response, so the next run does not repair it again.
+    Returns (paragraphs, model name, quality).
+    """
+    response, model_name = generate_cached_email_content(prompt, model, None, cache, namespace, telemetry,
+                                                         return_model=True, generation_config=EMAIL_GENERATION_CONFIG)
+    paragraphs, model_name, quality = repair_email_paragraphs(prompt, parse_email_response(response), model_name,
+                                                              model, rules, telemetry, max_repairs)
+    if cache is not None and quality["status"] == "repaired":
+        cache.put(response_cache_key(namespace, prompt), email_response_json(paragraphs), model_name)
+    return paragraphs, model_name, quality
+
+
+# Finished rows of bulk runs are checkpointed so a rerun or crash never loses them
+JOB_STORE_PATH = "bulk_jobs.sqlite3"
+# Finished rows are read back for export this many at a time
+EXPORT_CHUNK_ROWS = 5000
+ACTIVE_JOB_STATUSES = ("queued", "running")
+
+
+class JobStore:
+    """SQLite store and queue of bulk jobs and their finished rows, used to resume interrupted runs.
+
+    A job is identified by a hash of its owner, input rows and run settings, so the owner
+    submitting the same CSV with the same settings again picks up where the previous run
+    stopped.
+    Submitted jobs wait as 'queued' until a BulkJobWorkers process claims them.
+    Thread safe, so worker threads can checkpoint their rows as soon as they finish.
+    """
+
+    def __init__(self, path=JOB_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = connect_sqlite(path)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id TEXT PRIMARY KEY, created_at REAL NOT NULL, updated_at REAL NOT NULL, "
+                "total_rows INTEGER NOT NULL, status TEXT NOT NULL, settings TEXT NOT NULL, "
+                "owner TEXT NOT NULL DEFAULT '', input_path TEXT NOT NULL DEFAULT '', "
+                "queued_at REAL NOT NULL DEFAULT 0, metrics TEXT NOT NULL DEFAULT '', key_ids TEXT NOT NULL DEFAULT '')"
+            )
+            for column in ("owner", "input_path", "metrics", "key_ids"):
+                add_missing_column(self._conn, "jobs", column, "TEXT NOT NULL DEFAULT ''")
+            add_missing_column(self._conn, "jobs", "queued_at", "REAL NOT NULL DEFAULT 0")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_rows ("
+                "job_id TEXT NOT NULL, row_index INTEGER NOT NULL, lead TEXT NOT NULL, "
+                "paragraph1 TEXT NOT NULL, paragraph2 TEXT NOT NULL, paragraph3 TEXT NOT NULL, "
+                "model TEXT NOT NULL DEFAULT '', quality TEXT NOT NULL DEFAULT '', finished_at REAL NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (job_id, row_index))"
+            )
+            for column in ("model", "quality"):
+                add_missing_column(self._conn, "job_rows", column, "TEXT NOT NULL DEFAULT ''")
+            add_missing_column(self._conn, "job_rows", "finished_at", "REAL NOT NULL DEFAULT 0")
+            # Requests per API key fingerprint, model and day, so daily quotas hold across jobs
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS daily_requests (key_id TEXT NOT NULL, model TEXT NOT NULL, "
+                "day INTEGER NOT NULL, requests INTEGER NOT NULL, PRIMARY KEY (key_id, model, day))"
+            )
+
+    def start_job(self, job_id, total_rows, settings):
+        """Register a job, or mark an existing one as running again."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO jobs (job_id, created_at, updated_at, total_rows, status, settings) "
+                "VALUES (?, ?, ?, ?, 'running', ?)",
+                (job_id, now, now, total_rows, json.dumps(settings, default=str))
+            )
+            self._conn.execute("UPDATE jobs SET status = 'running', updated_at = ? WHERE job_id = ?", (now, job_id))
+
+    def save_row(self, job_id, row_index, lead, paragraphs, model="", quality=None):
+        """Checkpoint one finished row, the model that wrote it and its quality verdict."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO job_rows "
+                "(job_id, row_index, lead, paragraph1, paragraph2, paragraph3, model, quality, finished_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, row_index, json.dumps(lead, default=str), *paragraphs[:3], model,
+                 json.dumps(quality) if quality else "", now)
+            )
+            self._conn.execute("UPDATE jobs SET updated_at = ? WHERE job_id = ?", (now, job_id))
+
+    def set_status(self, job_id, status, metrics=None):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE job_id = ?",
+                               (status, time.time(), job_id))
+            if metrics is not None:
+                self._conn.execute("UPDATE jobs SET metrics = ? WHERE job_id = ?",
+                                   (json.dumps(metrics, default=str), job_id))
+
+    def can_submit(self, job_id, owner):
+        """Whether ``owner`` may queue this job: it is new, or theirs and neither queued nor running."""
+        with self._lock:
+            row = self._conn.execute("SELECT status, owner FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row is None or (row[1] == owner and row[0] not in ACTIVE_JOB_STATUSES)
+
+    def submit_job(self, job_id, owner, total_rows, input_path, settings, key_ids=()):
+        """Queue a job for the background workers; returns False if it is active or another owner's.
+
+        ``key_ids`` are the api_key_id fingerprints of the keys the job will use.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT status, owner FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                self._conn.execute(
+                    "INSERT INTO jobs (job_id, created_at, updated_at, total_rows, status, settings, owner, "
+                    "input_path, queued_at, key_ids) VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?, ?)",
+                    (job_id, now, now, total_rows, json.dumps(settings, default=str), owner, input_path, now,
+                     json.dumps(list(key_ids)))
+                )
+                return True
+            if row[1] != owner or row[0] in ACTIVE_JOB_STATUSES:
+                return False
+            self._conn.execute(
+                "UPDATE jobs SET updated_at = ?, total_rows = ?, status = 'queued', settings = ?, input_path = ?, "
+                "queued_at = ?, key_ids = ? WHERE job_id = ?",
+                (now, total_rows, json.dumps(settings, default=str), input_path, now, json.dumps(list(key_ids)),
+                 job_id)
+            )
+            return True
+
+    def claim_next_job(self):
+        """Mark the next queued job as running and return it, or None when no queued job can start.
+
+        Jobs of the owner with the fewest running jobs go first, oldest first within that,
+        so one user's backlog cannot starve everyone else. A job sharing an API key with a
+        running job waits, so each key's rate limits are paced by one worker at a time.
+        """
+        with self._lock, self._conn:
+            busy_keys = set()
+            for (key_ids,) in self._conn.execute("SELECT key_ids FROM jobs WHERE status = 'running'"):
+                busy_keys.update(json.loads(key_ids or "[]"))
+            rows = self._conn.execute(
+                "SELECT job_id, owner, input_path, settings, key_ids FROM jobs AS queued WHERE status = 'queued' "
+                "ORDER BY (SELECT COUNT(*) FROM jobs AS running "
+                "WHERE running.owner = queued.owner AND running.status = 'running'), queued_at"
+            ).fetchall()
+            row = next((row for row in rows if busy_keys.isdisjoint(json.loads(row[4] or "[]"))), None)
+            if row is None:
+                return None
+            self._conn.execute("UPDATE jobs SET status = 'running', updated_at = ? WHERE job_id = ?",
+                               (time.time(), row[0]))
+        return {"job_id": row[0], "owner": row[1], "input_path": row[2], "settings": json.loads(row[3])}
+
+    def interrupt_unfinished_jobs(self):
+        """Mark jobs left queued or running by a previous server process as interrupted."""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET status = 'interrupted', updated_at = ? "
+                               "WHERE status IN ('queued', 'running')", (time.time(),))
+
+    def finished_qualities(self, job_id):
+        """Return {row_index: quality} for the job's finished rows, without loading their emails."""
+        with self._lock:
+            rows = self._conn.execute("SELECT row_index, quality FROM job_rows WHERE job_id = ?", (job_id,)).fetchall()
+        return {row[0]: json.loads(row[1]) if row[1] else None for row in rows}
+
+    def list_jobs(self, limit=20, owner=None):
+        """Most recently updated jobs (of ``owner``, when given) with their progress."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT jobs.job_id, jobs.created_at, jobs.updated_at, jobs.total_rows, jobs.status, "
+                "COUNT(job_rows.row_index), jobs.owner, jobs.metrics "
+                "FROM jobs LEFT JOIN job_rows ON jobs.job_id = job_rows.job_id "
+                "WHERE ? IS NULL OR jobs.owner = ? "
+                "GROUP BY jobs.job_id ORDER BY jobs.updated_at DESC LIMIT ?", (owner, owner, limit)
+            ).fetchall()
+        return [
+            {"job_id": row[0], "created_at": row[1], "updated_at": row[2], "total_rows": row[3],
+             "status": row[4], "completed_rows": row[5], "owner": row[6],
+             "metrics": json.loads(row[7]) if row[7] else None}
+            for row in rows
+        ]
+
+    def requests_today(self, key_id, model):
+        """Requests sent today to ``model`` with the API key fingerprinted ``key_id``."""
+        with self._lock:
+            row = self._conn.execute("SELECT requests FROM daily_requests WHERE key_id = ? AND model = ? AND day = ?",
+                                     (key_id, model, quota_day())).fetchone()
+        return row[0] if row else 0
+
+    def count_request(self, key_id, model):
+        """Add one request to today's count of ``model`` on the key fingerprinted ``key_id``."""
+        day = quota_day()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO daily_requests (key_id, model, day, requests) VALUES (?, ?, ?, 1) "
+                "ON CONFLICT (key_id, model, day) DO UPDATE SET requests = requests + 1",
+                (key_id, model, day)
+            )
+            self._conn.execute("DELETE FROM daily_requests WHERE day < ?", (day - 1,))
+
+    def add_metrics(self, job_id, **metrics):
+        """Merge ``metrics`` into the metrics stored with a job."""
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT metrics FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return
+            stored = dict(json.loads(row[0]) if row[0] else {}, **metrics)
+            self._conn.execute("UPDATE jobs SET metrics = ? WHERE job_id = ?",
+                               (json.dumps(stored, default=str), job_id))
+
+    def iter_job_results(self, job_id, chunk_rows=EXPORT_CHUNK_ROWS):
+        """Finished rows of a job as DataFrames of up to ``chunk_rows`` rows, in input order."""
+        last_index = -1
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT row_index, lead, paragraph1, paragraph2, paragraph3, model, quality FROM job_rows "
+                    "WHERE job_id = ? AND row_index > ? ORDER BY row_index LIMIT ?",
+                    (job_id, last_index, chunk_rows)
+                ).fetchall()
+            if not rows:
+                return
+            last_index = rows[-1][0]
+            yield self._results_frame(rows)
+
+    def latest_results(self, job_id, limit):
+        """The job's ``limit`` most recently finished rows, newest first, with their 1-based input row number."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT row_index, lead, paragraph1, paragraph2, paragraph3, model, quality FROM job_rows "
+                "WHERE job_id = ? ORDER BY finished_at DESC, row_index DESC LIMIT ?",
+                (job_id, limit)
+            ).fetchall()
+        frame = self._results_frame(rows)
+        frame.insert(0, "Row", [row[0] + 1 for row in rows])
+        return frame
+
+    @staticmethod
+    def _results_frame(rows):
+        """DataFrame of (row_index, lead, paragraph1-3, model, quality) job rows."""
+        records = []
+        for row_index, lead, paragraph1, paragraph2, paragraph3, model, quality in rows:
+            record = json.loads(lead)
+            record.update({"Paragraph1": paragraph1, "Paragraph2": paragraph2, "Paragraph3": paragraph3,
+                           "Model": model, "Quality": format_quality(json.loads(quality) if quality else None)})
+            records.append(record)
+        return pd.DataFrame(records)
+
+    def job_results(self, job_id):
+        """Finished rows of a job as a DataFrame in input order, usable while the job is still running."""
+        chunks = list(self.iter_job_results(job_id))
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+
+
+@st.cache_resource
+def get_job_store():
+    """Return the process-wide bulk job store."""
+    return JobStore()
+
+
+# Results are exported through a temp file that only spills to disk once it grows large
+EXPORT_SPOOL_BYTES = 16 * 1024 * 1024
+EXPORT_FORMATS = {
+    "CSV (gzip)": ("csv.gz", "application/gzip"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+
+
+def results_format(path):
+    """Output format of a results file, picked by its extension: "parquet", "csv.gz" or "csv"."""
+    if path.endswith(".parquet"):
+        return "parquet"
+    return "csv.gz" if path.endswith(".gz") else "csv"
+
+
+class ResultsWriter:
+    """Append DataFrame chunks to a binary file as CSV, gzip CSV or Parquet.
+
+    Every column is written as text, so chunks with different inferred dtypes still share
+    one Parquet schema.
+    """
+
+    def __init__(self, file, file_format):
+        self.file = file
+        self.file_format = file_format
+        self._stream = gzip.GzipFile(fileobj=file, mode="wb") if file_format == "csv.gz" else file
+        self._parquet = None
+        self._header = True
+
+    def write(self, chunk):
+        if self.file_format == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(chunk.astype(str), preserve_index=False)
+            if self._parquet is None:
+                self._parquet = pq.ParquetWriter(self.file, table.schema, compression="zstd")
+            self._parquet.write_table(table.cast(self._parquet.schema))
+        else:
+            self._stream.write(chunk.to_csv(index=False, header=self._header).encode("utf-8"))
+        self._header = False
+
+    def close(self):
+        if self._parquet is not None:
+            self._parquet.close()
+        elif self._stream is not self.file:
+            self._stream.close()
+
+
+def export_job_results(job_store, job_id, file_format):
+    """A job's finished rows as a CSV, gzip CSV or Parquet file, returned as bytes.
+
+    Rows are read from the job store and written one chunk at a time, so the full result
+    never exists as a DataFrame or as an uncompressed string.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as spool:
+        writer = ResultsWriter(spool, file_format)
+        for chunk in job_store.iter_job_results(job_id):
+            writer.write(chunk)
+        writer.close()
+        spool.seek(0)
+        return spool.read()
+
+
+def bulk_job_id(df, cta_text, custom_text, namespace, owner=""):
+    """Identify a bulk job by its owner, input rows and everything that shapes the generated text."""
+    digest = hashlib.sha256()
+    digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    digest.update(json.dumps([list(df.columns), cta_text, custom_text, namespace, owner]).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def parse_row_ranges(text, total_rows):
+    """Turn 1-based row numbers and ranges like "1-50, 120" into 0-based positions, in the order given.
+
+    Raises ValueError for anything that is not a number or range.
+    """
+    positions = []
+    for part in re.split(r'[,\s]+', text.strip()):
+        if not part:
+            continue
+        match = re.fullmatch(r'(\d+)(?:-(\d+))?', part)
+        if match is None:
+            raise ValueError(f"Not a row number or range: {part}")
+        start = int(match.group(1))
+        end = int(match.group(2) or start)
+        positions.extend(pos - 1 for pos in range(max(start, 1), min(end, total_rows) + 1))
+    return list(dict.fromkeys(positions))
+
+
+def edited_model_limits(limits_df):
+    """Per-model limits from the Advanced Model Settings table.
+
+    Cleared or non-numeric cells fall back to the model's default in MODEL_LIMITS.
+    """
+    model_limits = {}
+    for name, row in limits_df.iterrows():
+        defaults = MODEL_LIMITS.get(name, {"rpm": DEFAULT_RPM_LIMIT, "tpm": DEFAULT_TPM_LIMIT, "rpd": None})
+        limits = {}
+        for key, minimum in (("rpm", 1), ("tpm", 1000), ("rpd", 1)):
+            try:
+                value = int(row[key.upper()])
+            except (TypeError, ValueError, OverflowError):
+                value = defaults[key]
+            limits[key] = value if value is None else max(minimum, value)
+        model_limits[name] = limits
+    return model_limits
+
+
+# Contacts sharing these fields get one generated email, re-addressed locally to each member
+SEGMENT_COLUMNS = ['Role', 'Industry', 'Country', 'Company']
+
+
+def segment_key(lead, segment_columns):
+    """Normalized segment key of a contact."""
+    return tuple(str(lead[col]).strip().casefold() for col in segment_columns)
+
+
+def group_segments(leads, positions, segment_columns):
+    """Group row positions by segment; returns {representative_pos: [other member positions]}."""
+    representatives = {}
+    members = {}
+    for pos in positions:
+        key = segment_key(leads[pos], segment_columns)
+        if key in representatives:
+            members[representatives[key]].append(pos)
+        else:
+            representatives[key] = pos
+            members[pos] = []
+    return members
+
+
+def count_segments(df, segment_columns):
+    """Number of distinct segments in a contact list."""
+    if df.empty:
+        return 0
+    # segment_key's normalization, applied a column at a time
+    normalized = pd.DataFrame({col: df[col].astype(str).str.strip().str.casefold() for col in segment_columns})
+    return len(normalized.drop_duplicates())
+
+
+def personalize_paragraphs(paragraphs, source_lead, target_lead, fields):
+    """Re-address paragraphs generated for one contact to another contact of the same segment."""
+    replacements = {
+        str(source_lead[field]).strip(): str(target_lead[field]).strip()
+        for field in fields
+        if str(source_lead[field]).strip() and str(source_lead[field]).strip() != str(target_lead[field]).strip()
+    }
+    if not replacements:
+        return list(paragraphs)
+    # Longest values first, so "Ann Lee" is not partially rewritten by a shorter "Ann"
+    pattern = re.compile(r'\b(' + '|'.join(re.escape(value) for value in sorted(replacements, key=len, reverse=True))
+                         + r')\b')
+    return [pattern.sub(lambda match: replacements[match.group(0)], paragraph) for paragraph in paragraphs]
+
+
+# Pre-run planning: token counts are measured on a sample of rows and extrapolated
+DEFAULT_RPD_LIMIT = 1000
+PLANNER_SAMPLE_SIZE = 20
+PLANNER_DEFAULT_SECONDS_PER_REQUEST = 10.0
+
+
+def count_prompt_tokens(model, text):
+    """Token count of ``text`` from the API's count_tokens, or a local estimate if that fails."""
+    try:
+        return model.count_tokens(text).total_tokens
+    except Exception:
+        return estimate_tokens(text)
+
+
+def observed_job_usage(jobs):
+    """Model usage summed over the completed ``jobs`` (from JobStore.list_jobs) that recorded it."""
+    usage = {"emails": 0, "requests": 0, "output_tokens": 0, "wall_seconds": 0.0}
+    for job in jobs or []:
+        job_usage = (job["metrics"] or {}).get("usage")
+        if job["status"] == "completed" and job_usage:
+            for name in usage:
+                usage[name] += job_usage.get(name, 0)
+    return usage
+
+
+def plan_bulk_run(df, cta_text, custom_text, model, rpm, tpm, rpd, max_concurrency=1, batch_size=1,
+                  segment_columns=None, jobs=None, sample_size=PLANNER_SAMPLE_SIZE, seed=0):
+    """Estimate tokens, requests and wall-clock time of a bulk run before starting it.
+
+    Prompt sizes are measured with ``count_tokens`` on up to ``sample_size`` random rows and
+    extrapolated to the whole list. Output size per email and call latency come from the
+    usage stored with completed ``jobs`` when available. ``model`` should be the plain model
+    without the prompt prefix, so the prefix and the row prompts are counted separately.
+    """
+    total_rows = len(df)
+    emails = count_segments(df, segment_columns) if segment_columns else total_rows
+    batch_size = max(1, int(batch_size))
+    requests = -(-emails // batch_size)
+
+    sample = df.sample(n=min(sample_size, total_rows), random_state=seed).to_dict('records') if total_rows else []
+    prefix_tokens = count_prompt_tokens(model, build_prompt_prefix())
+    if not sample:
+        suffix_tokens_per_request = 0
+    elif batch_size > 1:
+        batch = {row_id: lead for row_id, lead in enumerate(sample[:batch_size])}
+        tokens_per_contact = count_prompt_tokens(model, build_batch_prompt(batch, cta_text, custom_text)) / len(batch)
+        suffix_tokens_per_request = tokens_per_contact * min(batch_size, emails)
+    else:
+        suffix_tokens_per_request = sum(
+            count_prompt_tokens(model, build_email_prompt(lead, cta_text, custom_text)) for lead in sample
+        ) / len(sample)
+
+    usage = observed_job_usage(jobs)
+    observed = bool(usage["emails"] and usage["requests"])
+    # A batched request answers several emails, so output is measured per email produced
+    output_tokens_per_email = (usage["output_tokens"] / usage["emails"] if observed
+                               else EXPECTED_OUTPUT_TOKENS) or EXPECTED_OUTPUT_TOKENS
+    seconds_per_request = (usage["wall_seconds"] / usage["requests"] if observed
+                           else PLANNER_DEFAULT_SECONDS_PER_REQUEST)
+
+    input_tokens = requests * (prefix_tokens + suffix_tokens_per_request)
+    output_tokens = emails * output_tokens_per_email
+    total_tokens = input_tokens + output_tokens
+    # The run is as slow as its tightest constraint: request budget, token budget or worker pool
+    minutes_by_rpm = requests / rpm
+    minutes_by_tpm = total_tokens / tpm
+    # Calls are dominated by output generation, so a batched call takes about as long as its emails
+    minutes_by_latency = emails * seconds_per_request / max(1, int(max_concurrency)) / 60
+    eta_minutes, bottleneck = max((minutes_by_rpm, "requests per minute"), (minutes_by_tpm, "tokens per minute"),
+                                  (minutes_by_latency, "model latency and concurrency"))
+
+    return {
+        "rows": total_rows,
+        "emails": emails,
+        "requests": requests,
+        "sampled_rows": len(sample),
+        "prefix_tokens": prefix_tokens,
+        "input_tokens": int(input_tokens),
+        "output_tokens": int(output_tokens),
+        "total_tokens": int(total_tokens),
+        "output_tokens_per_email": output_tokens_per_email,
+        "seconds_per_request": seconds_per_request,
+        "observed": observed,
+        "eta_minutes": eta_minutes,
+        "bottleneck": bottleneck,
+        "fits_daily_quota": requests <= rpd,
+        "days_needed": -(-requests // rpd),
+        "max_rows_per_day": rpd * batch_size * (total_rows / emails if emails else 1),
+    }
+
+
+def run_plan_panel(plan):
+    """Show a run plan from plan_bulk_run."""
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Requests", f"{plan['requests']:,}", help=f"{plan['emails']:,} emails for {plan['rows']:,} rows")
+    col2.metric("Input tokens", f"{plan['input_tokens']:,}",
+                help=f"Measured on {plan['sampled_rows']} sampled rows; the shared prefix is "
+                     f"{plan['prefix_tokens']:,} tokens per request")
+    col3.metric("Output tokens", f"{plan['output_tokens']:,}",
+                help=f"{plan['output_tokens_per_email']:.0f} per email "
+                     f"({'observed in completed jobs' if plan['observed'] else 'default estimate'})")
+    eta = plan['eta_minutes']
+    col4.metric("Estimated time", f"{int(eta // 60)}h {int(eta % 60):02d}m" if eta >= 60 else f"{eta:.1f} min",
+                help=f"Limited by {plan['bottleneck']}")
+    if plan['fits_daily_quota']:
+        st.success(f"Fits the daily request quota. Bottleneck: {plan['bottleneck']}.")
+    else:
+        st.warning(f"Needs {plan['requests']:,} requests, more than the daily quota allows. Split the list into "
+                   f"{plan['days_needed']} runs of at most {int(plan['max_rows_per_day']):,} rows, or raise "
+                   f"Contacts per Request / enable Segment mode.")
+
+
+# Live metrics of a running bulk job are written to the job store this often, for the jobs panel
+JOB_METRICS_SECONDS = 5.0
+
+# Run settings of a bulk job; the UI stores the chosen ones with each job it queues
+DEFAULT_BULK_SETTINGS = {
+    "cta": "",
+    "custom_text": "",
+    "template": PROMPT_TEMPLATE,
+    "row_template": ROW_PROMPT_TEMPLATE,
+    "generation_config": DEFAULT_GENERATION_CONFIG,
+    "max_concurrency": 1,
+    "batch_size": 1,
+    "segment_columns": None,
+    "max_repairs": MAX_REPAIR_ATTEMPTS,
+    "priority": None,
+}
+
+
+def generate_bulk_emails(df, settings, model=None, limiter=None, cache=None, job_store=None, job_id=None,
+                         telemetry=None):
+    """Generate an email for every contact with the run ``settings`` and add it as new columns.
+
+    With a ``job_store`` each finished row is checkpointed to the job instead, rows finished by
+    an earlier run of the same job are not generated again, and nothing is returned.
+    """
+    settings = dict(DEFAULT_BULK_SETTINGS, **settings)
+    cta_text, custom_text = settings["cta"], settings["custom_text"]
+    row_template, generation_config = settings["row_template"], settings["generation_config"]
+    segment_columns, max_repairs = settings["segment_columns"], settings["max_repairs"]
+    total_rows = len(df)
+    leads = LeadRows(df)
+    # Rows in flight by position; with a job store they are dropped again once checkpointed
+    results = {}
+    models = {}
+    qualities = {}
+    rules = template_quality_rules(settings["template"])
+    prefix = build_prompt_prefix(settings["template"])
+    if model is None:
+        model = get_model_router(prefix, MODEL_TIERS["bulk"])
+    router = as_router(model, limiter)
+    namespace = response_cache_namespace(prefix, generation_config, router.model_names)
+
+    if job_store is not None:
+        job_id = job_id or bulk_job_id(df, cta_text, custom_text, namespace)
+        job_store.start_job(job_id, total_rows, {"cta": cta_text, "custom_text": custom_text,
+                                                 "models": router.model_names})
+    checkpointed = job_store.finished_qualities(job_id) if job_store is not None else {}
+    report = quality_report(quality for pos, quality in checkpointed.items() if pos < total_rows)
+    pending = [pos for pos in range(total_rows) if pos not in checkpointed]
+    if settings["priority"]:
+        # The executor runs groups in submission order, so moving rows forward generates them first
+        first = [pos for pos in dict.fromkeys(settings["priority"])
+                 if 0 <= pos < total_rows and pos not in checkpointed]
+        first_set = set(first)
+        pending = first + [pos for pos in pending if pos not in first_set]
+    completed_before = total_rows - len(pending)
+    checkpointed = None
+    if completed_before:
+        notify("info", f"Resuming job {job_id}: {completed_before} of {total_rows} rows already generated")
+
+    def save_row(pos, paragraphs, model_name, quality):
+        if job_store is not None:
+            job_store.save_row(job_id, pos, leads[pos], paragraphs, model_name, quality)
+
+    def generate_row(pos):
+        prompt = build_email_prompt(leads[pos], cta_text, custom_text, row_template)
+        paragraphs, model_name, quality = generate_checked_email(prompt, router, rules, cache, namespace, telemetry,
+                                                                 max_repairs)
+        if quality["status"] != "error":
+            save_row(pos, paragraphs, model_name, quality)
+        return paragraphs, model_name, quality
+
+    def generate_rows(positions):
+        """Generate a group of rows, returning {pos: (paragraphs, model name, quality)}."""
+        if len(positions) == 1:
+            return {positions[0]: generate_row(positions[0])}
+
+        # Batched rows are cached under their single-row request, so either mode can reuse them
+        prompts = {pos: build_email_prompt(leads[pos], cta_text, custom_text, row_template) for pos in positions}
+        cache_keys = {pos: response_cache_key(namespace, prompt) for pos, prompt in prompts.items()}
+        rows = {}
+        uncached = {}
+
+        def check_row(pos, paragraphs, model_name, is_new):
+            paragraphs, model_name, quality = repair_email_paragraphs(prompts[pos], paragraphs, model_name, router,
+                                                                      rules, telemetry, max_repairs)
+            if cache is not None and (is_new or quality["status"] == "repaired"):
+                cache.put(cache_keys[pos], email_response_json(paragraphs), model_name)
+            save_row(pos, paragraphs, model_name, quality)
+            rows[pos] = (paragraphs, model_name, quality)
+
+        for pos in positions:
+            cached = cache.lookup(cache_keys[pos]) if cache is not None else None
+            if cached is None:
+                uncached[pos] = leads[pos]
+            else:
+                if telemetry is not None:
+                    telemetry.record_request(0.0, cache_hit=True)
+                check_row(pos, parse_email_response(cached[0]), cached[1], is_new=False)
+
+        answered = (generate_batch_paragraphs(uncached, cta_text, custom_text, router, None, row_template,
+                                              telemetry=telemetry)
+                    if uncached else {})
+        for pos, (paragraphs, model_name) in answered.items():
+            check_row(pos, paragraphs, model_name, is_new=True)
+        # Rows the batch never answered fall back to their own request
+        for pos in uncached:
+            if pos not in rows:
+                rows[pos] = generate_row(pos)
+        return rows
+
+    def live_metrics():
+        metrics = telemetry.summary()
+        if cache is not None:
+            metrics["cache"] = {"hits": cache.hits, "misses": cache.misses}
+        return metrics
+
+    stop_snapshots = threading.Event()
+
+    def snapshot_metrics():
+        while not stop_snapshots.wait(JOB_METRICS_SECONDS):
+            job_store.add_metrics(job_id, **live_metrics())
+
+    members = {pos: [] for pos in pending}
+    if segment_columns:
+        members = group_segments(leads, pending, segment_columns)
+        notify("info", f"Segment mode: generating {len(members)} emails for {len(pending)} contacts")
+    local_fields = [col for col in REQUIRED_COLUMNS if col not in (segment_columns or [])]
+    representatives = list(members)
+
+    batch_size = max(1, int(settings["batch_size"]))
+    groups = [representatives[i:i + batch_size] for i in range(0, len(representatives), batch_size)]
+    failed_rows = 0
+    generated = 0
+    snapshots = None
+    if telemetry is not None:
+        telemetry.start_run(total_rows, completed_before)
+        baseline = telemetry.summary()
+        if job_store is not None:
+            # Rates, ETA and cache counters of the run in progress, read by the jobs panel
+            snapshots = threading.Thread(target=snapshot_metrics, name="job-metrics", daemon=True)
+            snapshots.start()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, int(settings["max_concurrency"]))) as executor:
+            futures = {executor.submit(generate_rows, positions): positions for positions in groups}
+            for future in as_completed(futures):
+                positions = futures[future]
+                try:
+                    for pos, (paragraphs, model_name, quality) in future.result().items():
+                        results[pos] = paragraphs
+                        models[pos] = model_name
+                        qualities[pos] = quality
+                except Exception as e:
+                    for pos in positions:
+                        lead = leads[pos]
+                        notify("error", f"Error generating email for {lead['First Name']} {lead['Last Name']}: "
+                                        f"{str(e)}")
+                        results[pos] = [f"Error: {str(e)}", "", ""]
+                        models[pos] = ""
+                        qualities[pos] = {"status": "error", "repairs": 0, "found": [], "issues": []}
+                for pos in positions:
+                    for member in members[pos]:
+                        models[member] = models[pos]
+                        # Members share the representative's verdict; its repairs are not counted again
+                        qualities[member] = dict(qualities[pos], repairs=0, found=[])
+                        if results[pos][0].startswith("Error:"):
+                            results[member] = list(results[pos])
+                        else:
+                            results[member] = personalize_paragraphs(results[pos], leads[pos], leads[member],
+                                                                     local_fields)
+                            save_row(member, results[member], models[member], qualities[member])
+                finished = [member for pos in positions for member in [pos] + members[pos]]
+                failed_rows += sum(results[pos][0].startswith("Error:") for pos in finished)
+                generated += sum(not results[pos][0].startswith("Error:") for pos in positions)
+                quality_report((qualities[pos] for pos in finished), report)
+                if job_store is not None:
+                    for pos in finished:
+                        del results[pos], models[pos], qualities[pos]
+
+                if telemetry is not None:
+                    telemetry.rows_done(len(finished))
+    finally:
+        stop_snapshots.set()
+        if snapshots is not None:
+            snapshots.join()
+
+    if job_store is not None:
+        metrics = live_metrics() if telemetry is not None else {}
+        if telemetry is not None:
+            # This run's own model usage, which plan_bulk_run learns output size and latency from
+            metrics["usage"] = {
+                "emails": max(0, generated - (metrics["cache_hits"] - baseline["cache_hits"])),
+                "requests": metrics["requests"] - baseline["requests"],
+                "output_tokens": metrics["output_tokens"] - baseline["output_tokens"],
+                "wall_seconds": metrics["wall_seconds"] - baseline["wall_seconds"],
+            }
+        job_store.set_status(job_id, "failed" if failed_rows else "completed", dict(metrics, quality=report))
+        return None
+
+    positions = range(total_rows)
+    return df.assign(
+        Paragraph1=[results[pos][0] for pos in positions],
+        Paragraph2=[results[pos][1] for pos in positions],
+        Paragraph3=[results[pos][2] for pos in positions],
+        Model=[models[pos] for pos in positions],
+        Quality=[format_quality(qualities[pos]) for pos in positions],
+    )
+
+
+# Bulk jobs run in background worker processes; the UI only submits and polls them
+JOB_WORKER_PROCESSES = 2
+MAX_CONCURRENT_MODEL_CALLS = 16
+JOB_INPUT_DIR = "bulk_job_inputs"
+JOB_POLL_SECONDS = 2.0
+LIVE_RESULTS_ROWS = 100
+MEMORY_SAMPLE_SECONDS = 0.5
+
+# Server-wide model call slots, set in each job worker process by init_job_worker
+job_call_slots = None
+
+
+class CallSlotModel:
+    """Model wrapper that holds one of the server-wide model call slots for the duration of each call."""
+
+    def __init__(self, model, call_slots):
+        self.model = model
+        self.call_slots = call_slots
+        self.model_name = getattr(model, 'model_name', None)
+        self.prefix_tokens = getattr(model, 'prefix_tokens', 0)
+
+    def generate_content(self, *args, **kwargs):
+        with self.call_slots:
+            return self.model.generate_content(*args, **kwargs)
+
+    def count_tokens(self, *args, **kwargs):
+        return self.model.count_tokens(*args, **kwargs)
+
+
+def create_model_router(prefix, generation_config, model_names, model_limits, api_keys, backend="gemini",
+                        call_slots=None, **backend_options):
+    """Router over ``model_names`` on every API key, built without a Streamlit session (CLI and job workers).
+
+    ``backend_options`` are passed to the fake backend; ``call_slots`` caps concurrent calls.
+    """
+    if backend == "gemini":
+        keys = ApiKeyPool(api_keys).keys
+    else:
+        # Fake keys only split the budgets, like real keys do
+        keys = [ApiKey(api_key) for api_key in api_keys] or [None]
+    routes = []
+    for name in model_names:
+        limits = model_limits.get(name, {"rpm": DEFAULT_RPM_LIMIT, "tpm": DEFAULT_TPM_LIMIT, "rpd": None})
+        for key in keys:
+            if backend == "gemini":
+                model = create_gemini_backend(prefix, generation_config, model_name=name, clients=key.clients)
+            else:
+                model = create_fake_backend(prefix, generation_config, model_name=name, **backend_options)
+            if call_slots is not None:
+                model = CallSlotModel(model, call_slots)
+            routes.append(ModelRoute(name, model, RateLimiter(limits["rpm"], limits["tpm"]), limits.get("rpd"), key))
+    return ModelRouter(routes)
+
+
+def resident_memory_bytes():
+    """Resident set size of this process, or 0 where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+class MemoryMonitor:
+    """Samples the resident memory of this process in a background thread while a job runs.
+
+    Each worker process runs one job at a time, so its memory is the job's memory.
+    """
+
+    def __init__(self, interval=MEMORY_SAMPLE_SECONDS, sample=resident_memory_bytes):
+        self.interval = interval
+        self.sample = sample
+        self.start = self.peak = self.end = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="memory-monitor", daemon=True)
+
+    def __enter__(self):
+        self.start = self.peak = self.sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.end = self.sample()
+        self.peak = max(self.peak, self.end)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.sample())
+
+    def summary(self):
+        megabyte = 1024 * 1024
+        return {"rss_start_mb": self.start / megabyte, "rss_peak_mb": self.peak / megabyte,
+                "rss_end_mb": self.end / megabyte}
+
+
+def init_job_worker(call_slots):
+    """Initializer of each job worker process."""
+    global job_call_slots
+    job_call_slots = call_slots
+    # st.* calls are no-ops outside `streamlit run`; keep their context warnings out of the server log
+    streamlit_logger.set_log_level("error")
+
+
+def run_bulk_job(db_path, job, api_keys):
+    """Job worker entry point: generate one claimed bulk job, checkpointing its rows in the job store."""
+    settings = job["settings"]
+    job_store = JobStore(db_path)
+    memory = MemoryMonitor()
+    input_mb = 0.0
+    try:
+        with memory:
+            df = pd.read_parquet(job["input_path"])
+            input_mb = df.memory_usage(deep=True).sum() / (1024 * 1024)
+            prefix = build_prompt_prefix(settings["template"])
+            router = create_model_router(prefix, settings["generation_config"], settings["models"],
+                                         settings["model_limits"], api_keys, settings.get("backend", "gemini"),
+                                         call_slots=job_call_slots, **settings.get("backend_options", {}))
+            for route in router.routes:
+                # Daily quotas span jobs: continue from today's count and record every request
+                key_id = api_key_id(route.key.api_key if route.key else None)
+                route.restore_requests_today(job_store.requests_today(key_id, route.name))
+                route.on_request = lambda route, key_id=key_id: job_store.count_request(key_id, route.name)
+            generate_bulk_emails(df, settings, router, cache=None if settings["bypass_cache"] else ResponseCache(),
+                                 job_store=job_store, job_id=job["job_id"], telemetry=Telemetry())
+    finally:
+        # Reported for failed jobs too, where running out of memory is a likely cause
+        job_store.add_metrics(job["job_id"], memory=dict(memory.summary(), input_mb=input_mb))
+    os.remove(job["input_path"])
+
+
+def job_worker_module():
+    """This file imported as a regular module, so spawned worker processes can unpickle its functions."""
+    # `streamlit run` executes the script as __main__, which worker processes cannot import by name
+    directory, filename = os.path.split(os.path.abspath(__file__))
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    return importlib.import_module(os.path.splitext(filename)[0])
+
+
+class BulkJobWorkers:
+    """Runs queued bulk jobs in a pool of worker processes, away from the Streamlit script threads.
+
+    A dispatcher thread claims the next job from the job store whenever a worker is free,
+    owners with the fewest running jobs first and never two jobs on one API key, since each
+    job paces its keys' rate limits on its own. Daily request counts per key and model are
+    kept in the job store, so daily quotas hold across jobs. All workers share one semaphore
+    that caps the number of model calls in flight across the server. API keys are handed
+    to the workers in memory only; the job store only keeps their fingerprints.
+    """
+
+    def __init__(self, job_store, processes=JOB_WORKER_PROCESSES, max_model_calls=MAX_CONCURRENT_MODEL_CALLS):
+        module = job_worker_module()
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = processes
+        self._init_job_worker = module.init_job_worker
+        self.job_store = job_store
+        self.call_slots = self._context.BoundedSemaphore(max_model_calls)
+        self.executor = self._new_executor()
+        self._run_bulk_job = module.run_bulk_job
+        self._api_keys = {}
+        self._submit_lock = threading.Lock()
+        self._free_workers = threading.Semaphore(processes)
+        self._wake = threading.Event()
+        # Jobs of a previous server process lost their workers and keys; resubmitting resumes them
+        job_store.interrupt_unfinished_jobs()
+        threading.Thread(target=self._dispatch, name="bulk-job-dispatcher", daemon=True).start()
+
+    def submit(self, job_id, owner, df, settings, api_keys):
+        """Queue ``df`` as a bulk job; returns False if the same job is already queued or running."""
+        # Only submit makes a job active, so checking first under this lock keeps a worker's input untouched
+        with self._submit_lock:
+            if not self.job_store.can_submit(job_id, owner):
+                return False
+            os.makedirs(JOB_INPUT_DIR, exist_ok=True)
+            input_path = os.path.abspath(os.path.join(JOB_INPUT_DIR, f"{job_id}.parquet"))
+            df.to_parquet(f"{input_path}.tmp", index=False)
+            os.replace(f"{input_path}.tmp", input_path)
+            self._api_keys[job_id] = list(api_keys)
+            key_ids = [api_key_id(api_key) for api_key in api_keys]
+            if not self.job_store.submit_job(job_id, owner, len(df), input_path, settings, key_ids):
+                self._api_keys.pop(job_id, None)
+                return False
+        self._wake.set()
+        return True
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(self._processes, mp_context=self._context, initializer=self._init_job_worker,
+                                   initargs=(self.call_slots,))
+
+    def _dispatch(self):
+        # Never let an error end this thread: queued jobs would wait forever
+        while True:
+            self._free_workers.acquire()
+            job = None
+            try:
+                job = self.job_store.claim_next_job()
+                while job is None:
+                    self._wake.wait(JOB_POLL_SECONDS)
+                    self._wake.clear()
+                    job = self.job_store.claim_next_job()
+                api_keys = self._api_keys.pop(job["job_id"], None)
+                if api_keys is None:
+                    self.job_store.set_status(job["job_id"], "interrupted")
+                    self._free_workers.release()
+                    continue
+                try:
+                    future = self.executor.submit(self._run_bulk_job, self.job_store.path, job, api_keys)
+                except BrokenProcessPool:
+                    # A worker process died (e.g. killed for running out of memory), which breaks the whole
+                    # pool: start a new one and put the job back at its place in the queue
+                    logging.error("Bulk job worker pool broken, starting a new one")
+                    self.executor.shutdown(wait=False, cancel_futures=True)
+                    self.executor = self._new_executor()
+                    self._api_keys[job["job_id"]] = api_keys
+                    self.job_store.set_status(job["job_id"], "queued")
+                    self._free_workers.release()
+                    continue
+                future.add_done_callback(functools.partial(self._job_done, job["job_id"]))
+            except Exception as e:
+                logging.error(f"Bulk job dispatcher error: {str(e)}")
+                try:
+                    if job is not None:
+                        self.job_store.set_status(job["job_id"], "failed")
+                except Exception as status_error:
+                    logging.error(f"Could not mark bulk job as failed: {str(status_error)}")
+                self._free_workers.release()
+                time.sleep(JOB_POLL_SECONDS)
+
+    def _job_done(self, job_id, future):
+        error = future.exception()
+        if error is not None:
+            logging.error(f"Bulk job {job_id} failed: {str(error)}")
+            self.job_store.set_status(job_id, "failed")
+        self._free_workers.release()
+        # Jobs waiting for this job's API keys can start now
+        self._wake.set()
+
+
+@st.cache_resource
+def get_bulk_job_workers():
+    """Return the process-wide pool of bulk job workers."""
+    return BulkJobWorkers(get_job_store())
+
+
+def get_session_telemetry():
+    """Return this session's request telemetry."""
+    if 'telemetry' not in st.session_state:
+        st.session_state.telemetry = Telemetry()
+    return st.session_state.telemetry
+
+
+def metrics_panel(telemetry):
+    """Show request metrics of this session and offer them as Prometheus text or JSON."""
+    summary = telemetry.summary()
+    if not summary["requests"] and not summary["cache_hits"]:
+        return
+
+    with st.expander("📈 Request Metrics"):
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Model calls", summary["requests"], help=f"{summary['cache_hits']} served from cache")
+        col2.metric("Rows/min", f"{summary['rows_per_minute']:.1f}")
+        col3.metric("Tokens/min", f"{summary['tokens_per_minute']:,.0f}")
+        col4.metric("Retries", summary["retries"])
+        st.caption(f"Prompt tokens: {summary['prompt_tokens']:,} · Output tokens: {summary['output_tokens']:,} · "
+                   f"Avg call: {summary['avg_request_seconds']:.2f}s · "
+                   f"Avg queue wait: {summary['avg_queue_wait_seconds']:.2f}s · "
+                   f"Errors: {summary['errors_by_class'] or 0}")
+        col1, col2 = st.columns(2)
+        col1.download_button("Download Prometheus Metrics", telemetry.to_prometheus(),
+                             file_name="email_generator_metrics.prom", mime="text/plain")
+        col2.download_button("Download JSON Metrics", telemetry.to_json(),
+                             file_name="email_generator_metrics.json", mime="application/json")
+
+
+def bulk_jobs_panel(job_store, owner=None):
+    """List the user's bulk jobs with live progress and offer their finished rows for download."""
+    jobs = job_store.list_jobs(owner=owner)
+    if not jobs:
+        return
+    active = any(job["status"] in ACTIVE_JOB_STATUSES for job in jobs)
+    # Poll the job store only while something is queued or running
+    st.fragment(run_every=JOB_POLL_SECONDS if active else None)(bulk_jobs_list)(job_store, owner, active)
+
+
+def bulk_jobs_list(job_store, owner, was_active):
+    jobs = job_store.list_jobs(owner=owner)
+    if was_active and not any(job["status"] in ACTIVE_JOB_STATUSES for job in jobs):
+        # The last job just finished: rerun the page once so polling stops
+        st.rerun()
+
+    with st.expander("🗂️ Bulk Jobs", expanded=was_active):
+        st.caption("Re-submit the same CSV with the same settings to resume an interrupted or failed job")
+        export_format = st.radio("Download format", list(EXPORT_FORMATS), horizontal=True, key="export_format")
+        extension, mime = EXPORT_FORMATS[export_format]
+        for job in jobs:
+            done, total = job["completed_rows"], job["total_rows"]
+            col1, col2 = st.columns([4, 1])
+            col1.progress(min(1.0, done / total) if total else 0.0,
+                          text=f"{job['job_id']} · {job['status']} · {done}/{total} rows · "
+                               f"{datetime.fromtimestamp(job['updated_at']):%Y-%m-%d %H:%M}")
+            metrics = job["metrics"] or {}
+            if job["status"] in ACTIVE_JOB_STATUSES and "rows_per_minute" in metrics:
+                col1.caption(format_run_metrics(metrics))
+            elif "requests" in metrics:
+                col1.caption(f"{metrics['requests']} model calls · {metrics['cache_hits']} cache hits · "
+                             f"{metrics['retries']} retries · avg call {metrics['avg_request_seconds']:.1f}s")
+            if metrics.get("cache"):
+                col1.caption(f"Response cache: {metrics['cache']['hits']} hits, {metrics['cache']['misses']} misses")
+            if metrics.get("quality"):
+                col1.caption(format_quality_report(metrics["quality"]))
+            if metrics.get("memory"):
+                memory = metrics["memory"]
+                col1.caption(f"Memory: input {memory['input_mb']:.1f} MB · worker RSS {memory['rss_start_mb']:.0f} MB "
+                             f"at start, {memory['rss_peak_mb']:.0f} MB peak")
+            col2.download_button(
+                label=f"Download {done:,} rows" if job["status"] in ACTIVE_JOB_STATUSES else "Download",
+                data=lambda job_id=job["job_id"]: export_job_results(job_store, job_id, extension),
+                file_name=f"personalized_emails_{job['job_id']}.{extension}",
+                mime=mime,
+                key=f"download_{job['job_id']}",
+                on_click="ignore",
+                disabled=not done
+            )
+
+        with_rows = [job["job_id"] for job in jobs if job["completed_rows"]]
+        if with_rows:
+            job_id = st.selectbox("Latest results of", with_rows, key="live_results_job")
+            st.dataframe(job_store.latest_results(job_id, LIVE_RESULTS_ROWS), hide_index=True)
+            st.caption(f"The {LIVE_RESULTS_ROWS} most recently finished rows, newest first. Download the job to "
+                       f"get every row finished so far")
+
+
+# Parsed uploads are kept per distinct file content, shared by reruns and sessions
+UPLOAD_CACHE_ENTRIES = 8
+RERUN_TIMING_HISTORY = 20
+
+SAMPLE_CSV = """First Name,Last Name,Company,Role,Industry,Country
+John,Smith,TechCorp Inc,IT Director,Healthcare,United States
+Sarah,Johnson,GlobalSys Ltd,CTO,Manufacturing,United Kingdom
+Michael,Chen,DataFlow Systems,System Administrator,Finance,Singapore
+Emma,Garcia,InnovateTech,IT Manager,Education,Canada
+David,Kumar,SecureNet Solutions,Infrastructure Lead,Banking,Australia"""
+
+
+def upload_content_hash(uploaded_file):
+    """SHA-256 of an uploaded file, hashed once per upload and remembered in the session."""
+    hashes = st.session_state.get('upload_hashes', {})
+    if uploaded_file.file_id not in hashes:
+        # Only the current upload is remembered
+        hashes = {uploaded_file.file_id: hashlib.sha256(uploaded_file.getvalue()).hexdigest()}
+        st.session_state.upload_hashes = hashes
+    return hashes[uploaded_file.file_id]
+
+
+@st.cache_resource(max_entries=UPLOAD_CACHE_ENTRIES, show_spinner="Reading contacts...")
+def load_leads(content_hash, _uploaded_file):
+    """Parse an upload with read_leads_csv once per distinct content.
+
+    The DataFrame is shared by every rerun and session that uploads the same file, so
+    it must not be modified in place.
+    """
+    _uploaded_file.seek(0)
+    return read_leads_csv(_uploaded_file)
+
+
+@st.cache_resource(max_entries=UPLOAD_CACHE_ENTRIES)
+def load_segment_count(content_hash, segment_columns, _df):
+    """count_segments of a parsed upload, computed once per content and segment columns."""
+    return count_segments(_df, segment_columns)
+
+
+class RerunTimer:
+    """Wall-clock time of the phases of one script rerun, for the debug panel."""
+
+    def __init__(self):
+        self.started = self.last = time.perf_counter()
+        self.phases = []
+
+    def mark(self, phase):
+        """End the current phase, naming it ``phase``."""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+
+def debug_panel(timer):
+    """Show how long this rerun took, phase by phase, next to the totals of the session's last reruns."""
+    total = timer.total()
+    history = st.session_state.setdefault('rerun_timings', deque(maxlen=RERUN_TIMING_HISTORY))
+    history.append(total)
+    with st.sidebar.expander("🐞 Debug: rerun timing"):
+        st.caption(f"This rerun: {total * 1000:.1f} ms · last {len(history)} reruns: "
+                   f"median {sorted(history)[len(history) // 2] * 1000:.1f} ms, max {max(history) * 1000:.1f} ms")
+        st.dataframe(pd.DataFrame({"Phase": [phase for phase, _ in timer.phases],
+                                   "ms": [round(seconds * 1000, 2) for _, seconds in timer.phases]}),
+                     hide_index=True)
 
 
 def main():
+    timer = RerunTimer()
+    main_page(timer)
+    debug_panel(timer)
+
+
+def main_page(timer):
     initialize_session_state()
 
     st.title("Hyper-Personalized B2B Email Generator")
 
+    timer.mark("setup")
+
     # Email verification before showing the main content
     if not email_verification_form():
         st.warning("Please enter your zohocorp.com email to access the tool")
@@ -378,6 +3234,7 @@ def main():
                      caption="Example of the Google AI Studio API key page (placeholder image)")
 
         return
+    timer.mark("access checks")
 
     # Documentation section
     with st.expander("📚 How to Use & Personalization Features"):
@@ -404,16 +3261,9 @@ def main():
     st.sidebar.header("Email Configuration")
 
     # Download sample CSV template
-    sample_csv = """First Name,Last Name,Company,Role,Industry,Country
-John,Smith,TechCorp Inc,IT Director,Healthcare,United States
-Sarah,Johnson,GlobalSys Ltd,CTO,Manufacturing,United Kingdom
-Michael,Chen,DataFlow Systems,System Administrator,Finance,Singapore
-Emma,Garcia,InnovateTech,IT Manager,Education,Canada
-David,Kumar,SecureNet Solutions,Infrastructure Lead,Banking,Australia"""
-
     st.sidebar.download_button(
         label="📥 Download Sample CSV Template",
-        data=sample_csv,
+        data=SAMPLE_CSV,
         file_name="sample_leads_template.csv",
         mime="text/csv",
     )
@@ -442,8 +3292,60 @@ David,Kumar,SecureNet Solutions,Infrastructure Lead,Banking,Australia"""
     with st.sidebar.expander("Advanced Model Settings"):
         temperature = st.slider("Temperature", min_value=0.0, max_value=1.0, value=0.7, step=0.1,
                                 help="Higher values make output more random, lower values more deterministic")
-        if temperature != 0.7 and st.session_state.genai_initialized:
-            st.session_state.model.generation_config["temperature"] = temperature
+        if st.session_state.genai_initialized:
+            # Replace rather than mutate: running requests and shared models keep the settings they started with
+            if st.session_state.generation_config.get("temperature") != temperature:
+                st.session_state.generation_config = dict(st.session_state.generation_config,
+                                                          temperature=temperature)
+        max_concurrency = st.slider("Concurrent Requests", min_value=1, max_value=32, value=4, step=1,
+                                    help="Number of contacts generated in parallel. Raise it until your API quota becomes the limit")
+        bulk_models = st.multiselect("Bulk models", list(MODEL_LIMITS), default=MODEL_TIERS["bulk"],
+                                     help="Models used for bulk runs, in order of preference. Requests spill over "
+                                          "to the next model when one is saturated or rate limited")
+        sample_models = st.multiselect("Sample models", list(MODEL_LIMITS), default=MODEL_TIERS["sample"],
+                                       help="Models used for the sample email, in order of preference")
+        bulk_models = bulk_models or MODEL_TIERS["bulk"]
+        sample_models = sample_models or MODEL_TIERS["sample"]
+        st.caption("Quota of each model per API key: requests per minute, tokens per minute and requests per "
+                   "day. Calls to each model are paced to stay under its own limits")
+        limits_df = st.data_editor(
+            pd.DataFrame.from_dict(MODEL_LIMITS, orient="index").rename(
+                columns={"rpm": "RPM", "tpm": "TPM", "rpd": "RPD"}),
+            key="model_limits"
+        )
+        model_limits = edited_model_limits(limits_df)
+        key_pool = st.session_state.get('key_pool')
+        active_keys = len(key_pool.available_keys()) if key_pool is not None else 1
+        if key_pool is not None and len(key_pool.keys) > 1:
+            quarantined = [f"{key.label} ({key.quarantine_reason})" for key in key_pool.keys if not key.is_available()]
+            st.caption(f"API key pool: {active_keys} of {len(key_pool.keys)} keys active"
+                       + (f"; quarantined: {', '.join(quarantined)}" if quarantined else ""))
+        batch_size = st.slider("Contacts per Request", min_value=1, max_value=MAX_BATCH_SIZE, value=1, step=1,
+                               help="Pack several contacts into one JSON-mode request to save requests on "
+                                    "per-request quotas. Contacts missing from a response are re-queued")
+        segment_mode = st.checkbox("Segment mode", value=False,
+                                   help="Generate one email per group of contacts sharing the selected fields "
+                                        "and personalize names locally")
+        segment_columns = st.multiselect("Segment by", SEGMENT_COLUMNS, default=SEGMENT_COLUMNS,
+                                         disabled=not segment_mode)
+        segment_columns = segment_columns if segment_mode else None
+        max_repairs = st.slider("Repair Rounds", min_value=0, max_value=5, value=MAX_REPAIR_ATTEMPTS, step=1,
+                                help="Emails breaking the template's rules (second person, no placeholders, no "
+                                     "signature) get up to this many rounds of regenerating only the failing "
+                                     "paragraphs")
+        bypass_cache = st.checkbox("Bypass response cache", value=False,
+                                   help="Always call the model, even for contacts generated before with the same settings")
+        shared_cache = get_response_cache()
+        response_cache = None if bypass_cache else shared_cache
+        # Bulk jobs look up the cache in their worker processes and report their counts with the job
+        job_caches = [(job["metrics"] or {}).get("cache", {})
+                      for job in get_job_store().list_jobs(owner=st.session_state.user_email)]
+        st.caption(f"Response cache: {shared_cache.hits} hits, {shared_cache.misses} misses for samples, "
+                   f"{sum(counts.get('hits', 0) for counts in job_caches)} hits, "
+                   f"{sum(counts.get('misses', 0) for counts in job_caches)} misses in your bulk jobs, "
+                   f"{len(shared_cache)} stored responses")
+
+    timer.mark("sidebar settings")
 
     # File upload
     st.header("Upload Contact List")
@@ -451,61 +3353,307 @@ David,Kumar,SecureNet Solutions,Infrastructure Lead,Banking,Australia"""
 
     if uploaded_file is not None:
         try:
-            df = pd.read_csv(uploaded_file)
-            required_columns = ['First Name', 'Last Name', 'Company', 'Role', 'Industry', 'Country']
-            if not all(col in df.columns for col in required_columns):
-                st.error(f"CSV must contain these columns: {', '.join(required_columns)}")
+            content_hash = upload_content_hash(uploaded_file)
+            try:
+                df = load_leads(content_hash, uploaded_file)
+            except ValueError as e:
+                st.error(str(e))
                 return
+            timer.mark("upload parsing")
 
             st.write("### Preview of uploaded data")
-            st.dataframe(df.head())
+            # Numbered from 1 like the row numbers of the priority field and the live results
+            preview_rows = df.head(PREVIEW_ROWS)
+            preview = st.dataframe(preview_rows.set_axis(range(1, len(preview_rows) + 1)), on_select="rerun",
+                                   selection_mode="multi-row", key="preview")
+            st.caption(f"{len(df):,} contacts, {df.memory_usage(deep=True).sum() / (1024 * 1024):.1f} MB in memory. "
+                       f"Showing the first {len(preview_rows):,}; select rows to generate them first")
+            priority_text = st.text_input("Generate these rows first", placeholder="E.g. 1-50, 120",
+                                          help="Row numbers or ranges generated before the rest of a bulk run, so "
+                                               "you can download and send them while it continues. Rows selected "
+                                               "in the preview are added")
+            try:
+                priority = list(dict.fromkeys(list(preview.selection.rows) +
+                                              parse_row_ranges(priority_text, len(df))))
+            except ValueError as e:
+                st.error(str(e))
+                priority = list(preview.selection.rows)
+
+            if segment_columns:
+                segments = load_segment_count(content_hash, segment_columns, df)
+                st.info(f"Segment mode: {len(df)} contacts share {segments} distinct "
+                        f"({', '.join(segment_columns)}) segments, so a full run needs {segments} generations "
+                        f"({len(df) / max(segments, 1):.1f}x fewer)")
+
+            if st.button("Estimate Cost & Duration"):
+                with st.spinner("Counting tokens..."):
+                    # Spill-over lets a run use the combined quota of all bulk models on all active keys
+                    count_model = get_client_registry().model(st.session_state.key_pool.keys[0].api_key, MODEL_NAME,
+                                                              st.session_state.generation_config)
+                    plan = plan_bulk_run(df, cta_text, custom_text, count_model,
+                                         active_keys * sum(model_limits[name]["rpm"] for name in bulk_models),
+                                         active_keys * sum(model_limits[name]["tpm"] for name in bulk_models),
+                                         active_keys * sum(model_limits[name]["rpd"] for name in bulk_models),
+                                         max_concurrency, batch_size, segment_columns,
+                                         get_job_store().list_jobs(owner=st.session_state.user_email))
+                run_plan_panel(plan)
 
             # Generate single example
             if st.button("Generate Sample Email"):
                 with st.spinner("Generating sample email..."):
                     # Use the first row for the sample
                     first_row = df.iloc[0]
-                    prompt = st.session_state.template.format(
-                        first_name=first_row['First Name'],
-                        last_name=first_row['Last Name'],
-                        company=first_row['Company'],
-                        role=first_row['Role'],
-                        industry=first_row['Industry'],
-                        country=first_row['Country'],
-                        product_description=ITOM['description'],
-                        product_features=", ".join(ITOM['features']),
-                        cta=cta_text,
-                        custom_text=custom_text
-                    )
-
-                    sample_email = generate_email_content(prompt)
+                    prompt = build_email_prompt(first_row, cta_text, custom_text)
+                    prefix = build_prompt_prefix()
+                    namespace = response_cache_namespace(prefix, st.session_state.generation_config, sample_models)
+
                     st.subheader(f"Sample Email for {first_row['First Name']} {first_row['Last Name']}")
-                    paragraphs = parse_email_paragraphs(sample_email)
+                    placeholders = [st.empty() for _ in range(3)]
+                    model_caption = st.empty()
+                    cache_key = response_cache_key(namespace, prompt)
+                    cached_email = response_cache.lookup(cache_key) if response_cache is not None else None
+
+                    router = get_model_router(prefix, sample_models, model_limits)
+                    if cached_email is not None:
+                        paragraphs = parse_email_response(cached_email[0])
+                        model_used = [cached_email[1]]
+                    else:
+                        # Render each paragraph as soon as it has streamed in
+                        paragraphs = []
+                        model_used = []
+                        for paragraph in stream_email_paragraphs(prompt, router, telemetry=get_session_telemetry(),
+                                                                 on_model=model_used.append):
+                            paragraphs.append(paragraph)
+                            placeholders[len(paragraphs) - 1].markdown(
+                                f"**Paragraph {len(paragraphs)}:**\n\n{paragraph}")
+                        paragraphs += [""] * (3 - len(paragraphs))
+
+                    # The sample streams free text, so it is checked and repaired after the fact
+                    checked_paragraphs, model_name, quality = repair_email_paragraphs(
+                        prompt, paragraphs, model_used[0] if model_used else "", router, template_quality_rules(),
+                        get_session_telemetry(), max_repairs)
+                    if response_cache is not None and quality["status"] in ("passed", "repaired") and (
+                            cached_email is None or quality["status"] == "repaired"):
+                        response_cache.put(cache_key, email_response_json(checked_paragraphs), model_name)
+                    paragraphs, model_used = checked_paragraphs, [model_name]
 
                     for i, paragraph in enumerate(paragraphs, 1):
-                        st.markdown(f"**Paragraph {i}:**\n\n{paragraph}")
+                        placeholders[i - 1].markdown(f"**Paragraph {i}:**\n\n{paragraph}")
+                    if model_used and model_used[0]:
+                        model_caption.caption(f"Generated with {model_used[0]}")
+                    if quality["status"] == "repaired":
+                        st.info(f"Repaired after {quality['repairs']} regeneration requests: the first draft "
+                                f"broke the rules ({', '.join(QUALITY_ISSUES[rule] for rule in quality['found'])})")
+                    elif quality["status"] == "failed":
+                        st.warning(f"Sample still breaks the writing rules: {format_quality_issues(quality['issues'])}")
 
             # Generate Emails Button
             if st.button("Generate Personalized Emails for All Contacts"):
-                with st.spinner("Generating personalized emails..."):
-                    result_df = generate_bulk_emails(df, cta_text, custom_text)
-
-                    # Show preview of results
-                    st.write("### Preview of generated emails")
-                    st.dataframe(result_df.head())
-
-                    # Download button
-                    csv = result_df.to_csv(index=False)
-                    st.download_button(
-                        label="Download Generated Emails CSV",
-                        data=csv,
-                        file_name="personalized_emails.csv",
-                        mime="text/csv"
-                    )
+                # The run happens in a background worker; this session only queues it
+                generation_config = dict(st.session_state.generation_config)
+                namespace = response_cache_namespace(build_prompt_prefix(), generation_config, bulk_models)
+                job_id = bulk_job_id(df, cta_text, custom_text, namespace, st.session_state.user_email)
+                settings = {
+                    "cta": cta_text,
+                    "custom_text": custom_text,
+                    "template": st.session_state.template,
+                    "row_template": st.session_state.row_template,
+                    "generation_config": generation_config,
+                    "models": bulk_models,
+                    "model_limits": model_limits,
+                    "max_concurrency": max_concurrency,
+                    "batch_size": batch_size,
+                    "segment_columns": segment_columns,
+                    "bypass_cache": bypass_cache,
+                    "max_repairs": max_repairs,
+                    "priority": priority,
+                }
+                api_keys = [key.api_key for key in st.session_state.key_pool.available_keys()]
+                if get_bulk_job_workers().submit(job_id, st.session_state.user_email, df, settings, api_keys):
+                    st.success(f"Job {job_id} queued"
+                               + (f", with {len(priority):,} priority rows first" if priority else "")
+                               + ". Finished rows show up under Bulk Jobs below as they are generated and can be "
+                                 "downloaded at any time.")
+                else:
+                    st.info(f"Job {job_id} is already queued or running.")
 
         except Exception as e:
             st.error(f"Error processing file: {str(e)}")
+        timer.mark("contact list")
+
+    metrics_panel(get_session_telemetry())
+    bulk_jobs_panel(get_bulk_job_workers().job_store, st.session_state.user_email)
+    timer.mark("metrics and jobs panels")
+
+
+def stream_bulk_emails(input_path, output_path, cta_text, custom_text, model, limiter, max_concurrency=4,
+                       chunk_size=1000, cache=None, namespace="", row_template=ROW_PROMPT_TEMPLATE,
+                       progress=None, on_row_done=None, telemetry=None, rules=(), max_repairs=MAX_REPAIR_ATTEMPTS,
+                       qualities=None):
+    """Generate emails for a CSV of any size, reading and writing it one chunk at a time.
+
+    Only ``chunk_size`` rows are held in memory; each chunk is generated with up to
+    ``max_concurrency`` parallel requests and appended to ``output_path`` in input order
+    (as CSV, or gzip CSV or Parquet when it ends in .gz or .parquet), with the model that wrote each row in a Model column (``model`` may be a ModelRouter).
+    Emails are checked against ``rules`` and repaired like in generate_bulk_emails, with each
+    row's verdict in a Quality column; the verdicts are also appended to ``qualities``.
+    ``on_row_done(seconds, paragraphs)`` is called from the worker threads after each row.
+    Returns (rows_written, failed_rows).
+    """
+    rows_written = 0
+    failed_rows = 0
+    router = as_router(model, limiter)
+
+    def generate_row(lead):
+        started = time.perf_counter()
+        prompt = build_email_prompt(lead, cta_text, custom_text, row_template)
+        try:
+            paragraphs, model_name, quality = generate_checked_email(prompt, router, rules, cache, namespace,
+                                                                     telemetry, max_repairs)
+        except Exception as e:
+            paragraphs, model_name = [f"Error: {str(e)}", "", ""], ""
+            quality = {"status": "error", "repairs": 0, "found": [], "issues": []}
+        if telemetry is not None:
+            telemetry.rows_done()
+        if on_row_done is not None:
+            on_row_done(time.perf_counter() - started, paragraphs)
+        return paragraphs, model_name, quality
+
+    reader = pd.read_csv(input_path, chunksize=chunk_size, dtype=str, keep_default_na=False)
+    with open(output_path, "wb") as output_file, \
+            ThreadPoolExecutor(max_workers=max(1, int(max_concurrency))) as executor:
+        writer = ResultsWriter(output_file, results_format(output_path))
+        for chunk_number, chunk in enumerate(reader):
+            if chunk_number == 0:
+                missing_columns = [col for col in REQUIRED_COLUMNS if col not in chunk.columns]
+                if missing_columns:
+                    raise ValueError(f"CSV must contain these columns: {', '.join(REQUIRED_COLUMNS)}")
+
+            results = list(executor.map(generate_row, chunk.to_dict('records')))
+            failed_rows += sum(paragraphs[0].startswith("Error:") for paragraphs, _, _ in results)
+            if qualities is not None:
+                qualities.extend(quality for _, _, quality in results)
+            chunk = chunk.assign(
+                Paragraph1=[paragraphs[0] for paragraphs, _, _ in results],
+                Paragraph2=[paragraphs[1] for paragraphs, _, _ in results],
+                Paragraph3=[paragraphs[2] for paragraphs, _, _ in results],
+                Model=[model_name for _, model_name, _ in results],
+                Quality=[format_quality(quality) for _, _, quality in results],
+            )
+            writer.write(chunk)
+            output_file.flush()
+            rows_written += len(chunk)
+            if progress is not None:
+                progress(rows_written, failed_rows)
+        writer.close()
+
+    return rows_written, failed_rows
+
+
+def parse_cli_args(argv=None):
+    """Parse the arguments of the headless batch mode."""
+    parser = argparse.ArgumentParser(
+        description="Generate personalized emails for a CSV of contacts without the Streamlit UI."
+    )
+    parser.add_argument("--input", required=True, help="CSV with the contact columns")
+    parser.add_argument("--output", required=True,
+                        help="File to write, with Paragraph1-3, Model and Quality appended: CSV, or gzip CSV "
+                             "or Parquet when it ends in .gz or .parquet")
+    parser.add_argument("--backend", choices=sorted(MODEL_BACKENDS), default="gemini")
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY"),
+                        help="Gemini API key, or several comma-separated keys to pool their quotas "
+                             "(defaults to $GEMINI_API_KEY)")
+    parser.add_argument("--cta", default="Demo Request",
+                        help=f"One of {', '.join(CTA_OPTIONS)} or a custom call-to-action")
+    parser.add_argument("--custom-text", default="", help="Custom context to incorporate")
+    parser.add_argument("--models", default=MODEL_NAME,
+                        help="Comma-separated models in order of preference; requests spill over to the next "
+                             "model when one is saturated or rate limited")
+    parser.add_argument("--temperature", type=float, default=DEFAULT_GENERATION_CONFIG["temperature"])
+    parser.add_argument("--concurrency", type=int, default=4, help="Parallel requests")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Rows read and written per chunk")
+    parser.add_argument("--rpm", type=int, default=DEFAULT_RPM_LIMIT,
+                        help="Requests per minute budget (per model when several models are given)")
+    parser.add_argument("--tpm", type=int, default=DEFAULT_TPM_LIMIT,
+                        help="Tokens per minute budget (per model when several models are given)")
+    parser.add_argument("--max-repairs", type=int, default=MAX_REPAIR_ATTEMPTS,
+                        help="Rounds of regenerating the paragraphs of an email that break the writing rules")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache")
+    parser.add_argument("--metrics-output",
+                        help="Write request metrics here when done (.prom for Prometheus text, otherwise JSON)")
+    parser.add_argument("--fake-latency", type=float, default=0.0, help="Fake backend: seconds per call")
+    parser.add_argument("--fake-latency-jitter", type=float, default=0.0,
+                        help="Fake backend: extra random seconds per call")
+    parser.add_argument("--fake-latency-distribution", choices=sorted(FAKE_LATENCY_DISTRIBUTIONS),
+                        default="uniform", help="Fake backend: distribution of the extra seconds")
+    parser.add_argument("--fake-error-rate", type=float, default=0.0, help="Fake backend: share of failing calls")
+    parser.add_argument("--fake-rate-limit-rate", type=float, default=0.0,
+                        help="Fake backend: share of calls answered with a 429")
+    parser.add_argument("--fake-flaw-rate", type=float, default=0.0,
+                        help="Fake backend: share of paragraphs that break a writing rule")
+    parser.add_argument("--seed", type=int, default=0, help="Fake backend: random seed")
+    return parser.parse_args(argv)
+
+
+def cli_main(argv=None):
+    """Headless batch mode: ``python ITOM.py --input leads.csv --output emails.csv``."""
+    args = parse_cli_args(argv)
+    print_generation_messages()
+
+    generation_config = dict(DEFAULT_GENERATION_CONFIG, temperature=args.temperature)
+    prefix = build_prompt_prefix(PROMPT_TEMPLATE)
+    model_names = [name.strip() for name in args.models.split(",") if name.strip()] or [MODEL_NAME]
+    api_keys = parse_api_keys(args.api_key)
+    if args.backend == "gemini" and not api_keys:
+        print("A Gemini API key is required: pass --api-key or set GEMINI_API_KEY", file=sys.stderr)
+        return 2
+    backend_options = {}
+    if args.backend == "fake":
+        backend_options = dict(latency=args.fake_latency, latency_jitter=args.fake_latency_jitter,
+                               error_rate=args.fake_error_rate, rate_limit_rate=args.fake_rate_limit_rate,
+                               seed=args.seed, latency_distribution=args.fake_latency_distribution,
+                               flaw_rate=args.fake_flaw_rate)
+    model_limits = {name: {"rpm": args.rpm, "tpm": args.tpm, "rpd": None} for name in model_names}
+    router = create_model_router(prefix, generation_config, model_names, model_limits, api_keys, args.backend,
+                                 **backend_options)
+
+    cache = None if args.no_cache else ResponseCache()
+    namespace = response_cache_namespace(prefix, generation_config, model_names)
+    if args.backend != "gemini":
+        namespace = f"{args.backend}:{namespace}"
+    started = time.monotonic()
+
+    def report(rows_written, failed_rows):
+        elapsed = time.monotonic() - started
+        summary = telemetry.summary()
+        print(f"{rows_written} rows written, {failed_rows} failed, {rows_written / elapsed:.1f} rows/s, "
+              f"{summary['tokens_per_minute']:,.0f} tokens/min, {summary['retries']} retries, "
+              f"{summary['cache_hits']} cache hits", file=sys.stderr)
+
+    telemetry = Telemetry()
+    telemetry.start_run(0)
+    qualities = []
+    try:
+        rows_written, failed_rows = stream_bulk_emails(
+            args.input, args.output, CTA_OPTIONS.get(args.cta, args.cta), args.custom_text, router,
+            None, max_concurrency=args.concurrency, chunk_size=args.chunk_size,
+            cache=cache, namespace=namespace, progress=report, telemetry=telemetry,
+            rules=template_quality_rules(PROMPT_TEMPLATE), max_repairs=args.max_repairs, qualities=qualities
+        )
+    except (OSError, ValueError) as e:
+        print(f"Error processing file: {str(e)}", file=sys.stderr)
+        return 1
+
+    if args.metrics_output:
+        with open(args.metrics_output, "w", encoding="utf-8") as f:
+            f.write(telemetry.to_prometheus() if args.metrics_output.endswith(".prom") else telemetry.to_json())
+    print(format_quality_report(quality_report(qualities)), file=sys.stderr)
+    print(f"Done: {rows_written} rows written to {args.output} ({failed_rows} failed)", file=sys.stderr)
+    return 0
 
 
 if __name__ == "__main__":
+    # `streamlit run ITOM.py` starts the app; plain `python ITOM.py ...` runs the batch mode
+    if get_script_run_ctx(suppress_warning=True) is None:
+        sys.exit(cli_main())
     main()
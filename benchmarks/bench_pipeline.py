@@ -0,0 +1,244 @@
+"""Offline benchmarks for the email generation pipeline.
+
+Everything runs against ITOM.FakeModel, so no API key or network access is needed:
+
+    python benchmarks/bench_pipeline.py --sizes 10,100,1000,10000 --output results.json
+    python benchmarks/bench_pipeline.py --sizes 100000 --latency 0.05 --latency-jitter 0.02 \
+        --latency-distribution lognormal --rate-limit-rate 0.01 --concurrency 32
+    python benchmarks/bench_pipeline.py --compare results.json
+
+Results are printed as a table and, with --output, written as JSON so runs of
+different versions can be compared with --compare.
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import ITOM  # noqa: E402
+
+FIRST_NAMES = ["John", "Sarah", "Michael", "Emma", "David", "Priya", "Wei", "Carlos", "Fatima", "Olga"]
+LAST_NAMES = ["Smith", "Johnson", "Chen", "Garcia", "Kumar", "Müller", "Okafor", "Rossi", "Tanaka", "Silva"]
+COMPANIES = ["TechCorp Inc", "GlobalSys Ltd", "DataFlow Systems", "InnovateTech", "SecureNet Solutions"]
+ROLES = ["IT Director", "CTO", "System Administrator", "IT Manager", "Infrastructure Lead", "NetOps Engineer"]
+INDUSTRIES = ["Healthcare", "Manufacturing", "Finance", "Education", "Banking", "Retail", "Telecom"]
+COUNTRIES = ["United States", "United Kingdom", "Singapore", "Canada", "Australia", "India", "Germany"]
+
+
+def write_synthetic_leads(path, rows, seed=0):
+    """Write a lead CSV with the columns the app requires."""
+    rng = random.Random(seed)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(ITOM.REQUIRED_COLUMNS)
+        for i in range(rows):
+            writer.writerow([
+                f"{rng.choice(FIRST_NAMES)}{i}", rng.choice(LAST_NAMES), rng.choice(COMPANIES),
+                rng.choice(ROLES), rng.choice(INDUSTRIES), rng.choice(COUNTRIES)
+            ])
+
+
+def percentiles(values):
+    """p50/p95/p99 of a list of seconds, in milliseconds."""
+    if not values:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    if len(values) == 1:
+        return {"p50_ms": values[0] * 1000, "p95_ms": values[0] * 1000, "p99_ms": values[0] * 1000}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50_ms": cuts[49] * 1000, "p95_ms": cuts[94] * 1000, "p99_ms": cuts[98] * 1000}
+
+
+def timed(func, repeat):
+    """Best wall time of ``repeat`` calls of ``func``."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def bench_prompt_rendering(leads, repeat):
+    prefix_seconds = timed(lambda: ITOM.build_prompt_prefix(ITOM.PROMPT_TEMPLATE), repeat)
+    seconds = timed(lambda: [ITOM.build_email_prompt(lead, "CTA", "Context", ITOM.ROW_PROMPT_TEMPLATE)
+                             for lead in leads], repeat)
+    return {"benchmark": "prompt_rendering", "rows": len(leads), "seconds": seconds,
+            "throughput_rows_per_s": len(leads) / seconds, "prefix_ms": prefix_seconds * 1000}
+
+
+def bench_parsing(responses, repeat):
+    seconds = timed(lambda: [ITOM.parse_email_paragraphs(response) for response in responses], repeat)
+    return {"benchmark": "parse_email_paragraphs", "rows": len(responses), "seconds": seconds,
+            "throughput_rows_per_s": len(responses) / seconds}
+
+
+def bench_result_assembly(df, results, repeat):
+    """Compare the old per-row ``df.at`` writes with the column assignment used now."""
+    def per_row_at():
+        out = df.copy()
+        out['Paragraph1'] = ""
+        out['Paragraph2'] = ""
+        out['Paragraph3'] = ""
+        for idx, paragraphs in zip(out.index, results):
+            out.at[idx, 'Paragraph1'] = paragraphs[0]
+            out.at[idx, 'Paragraph2'] = paragraphs[1]
+            out.at[idx, 'Paragraph3'] = paragraphs[2]
+
+    def column_assign():
+        df.assign(
+            Paragraph1=[paragraphs[0] for paragraphs in results],
+            Paragraph2=[paragraphs[1] for paragraphs in results],
+            Paragraph3=[paragraphs[2] for paragraphs in results],
+        )
+
+    at_seconds = timed(per_row_at, repeat)
+    assign_seconds = timed(column_assign, repeat)
+    return [
+        {"benchmark": "result_assembly_df_at", "rows": len(df), "seconds": at_seconds,
+         "throughput_rows_per_s": len(df) / at_seconds},
+        {"benchmark": "result_assembly_assign", "rows": len(df), "seconds": assign_seconds,
+         "throughput_rows_per_s": len(df) / assign_seconds},
+    ]
+
+
+def bench_end_to_end(input_path, rows, args):
+    """Stream a CSV through the batch pipeline against the fake backend."""
+    model = ITOM.FakeModel(latency=args.latency, latency_jitter=args.latency_jitter,
+                           latency_distribution=args.latency_distribution, error_rate=args.error_rate,
+                           rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after, seed=args.seed)
+    limiter = ITOM.RateLimiter(args.rpm, args.tpm)
+    latencies = []
+    failed = []
+    lock = threading.Lock()
+
+    def on_row_done(seconds, paragraphs):
+        with lock:
+            latencies.append(seconds)
+            if paragraphs[0].startswith("Error:"):
+                failed.append(seconds)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tracemalloc.start()
+        started = time.perf_counter()
+        ITOM.stream_bulk_emails(input_path, os.path.join(tmp, "out.csv"), "CTA", "Context", model, limiter,
+                                max_concurrency=args.concurrency, chunk_size=args.chunk_size,
+                                on_row_done=on_row_done)
+        seconds = time.perf_counter() - started
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    result = {"benchmark": "end_to_end", "rows": rows, "seconds": seconds,
+              "throughput_rows_per_s": rows / seconds, "peak_memory_mb": peak_bytes / 2 ** 20,
+              "retries": limiter.throttle_count, "failed_rows": len(failed)}
+    result.update(percentiles(latencies))
+    return result
+
+
+def run(args):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in args.sizes:
+            input_path = os.path.join(tmp, f"leads_{rows}.csv")
+            write_synthetic_leads(input_path, rows, args.seed)
+            df = pd.read_csv(input_path, dtype=str, keep_default_na=False)
+            leads = df.to_dict('records')
+            model = ITOM.FakeModel(seed=args.seed)
+            responses = [model.generate_content(ITOM.build_email_prompt(lead, "CTA", "Context",
+                                                                        ITOM.ROW_PROMPT_TEMPLATE)).text
+                         for lead in leads]
+
+            results.append(bench_prompt_rendering(leads, args.repeat))
+            results.append(bench_parsing(responses, args.repeat))
+            results.extend(bench_result_assembly(df, [ITOM.parse_email_paragraphs(r) for r in responses],
+                                                 args.repeat))
+            if not args.skip_end_to_end:
+                results.append(bench_end_to_end(input_path, rows, args))
+            print(f"finished {rows} rows", file=sys.stderr)
+    return results
+
+
+def metadata(args):
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        revision = ""
+    return {"timestamp": datetime.now().isoformat(timespec="seconds"), "git_revision": revision,
+            "python": platform.python_version(), "pandas": pd.__version__, "platform": platform.platform(),
+            "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")}}
+
+
+def print_table(results, baseline=None):
+    baseline = {(r["benchmark"], r["rows"]): r for r in (baseline or [])}
+    header = f"{'benchmark':<24}{'rows':>8}{'rows/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}" \
+             f"{'peak MB':>9}{'retries':>9}"
+    if baseline:
+        header += f"{'vs base':>9}"
+    print(header)
+    for r in results:
+        line = f"{r['benchmark']:<24}{r['rows']:>8}{r['throughput_rows_per_s']:>12.1f}"
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            line += f"{r[key]:>10.1f}" if r.get(key) is not None else f"{'':>10}"
+        line += f"{r['peak_memory_mb']:>9.1f}" if "peak_memory_mb" in r else f"{'':>9}"
+        line += f"{r['retries']:>9}" if "retries" in r else f"{'':>9}"
+        base = baseline.get((r["benchmark"], r["rows"]))
+        if base:
+            line += f"{r['throughput_rows_per_s'] / base['throughput_rows_per_s']:>8.2f}x"
+        print(line)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the email generation pipeline offline.")
+    parser.add_argument("--sizes", default="10,100,1000,10000",
+                        type=lambda value: [int(size) for size in value.split(",")],
+                        help="Comma-separated lead counts (e.g. 10,100,1000,10000,100000)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Fixed seconds per fake model call")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="Spread of the extra seconds per call")
+    parser.add_argument("--latency-distribution", choices=sorted(ITOM.FAKE_LATENCY_DISTRIBUTIONS),
+                        default="uniform")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of calls answered with a 429")
+    parser.add_argument("--retry-after", type=float, default=0.05, help="Retry hint sent with injected 429s")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of calls failing with a 500")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--rpm", type=int, default=10 ** 9, help="Rate limiter budget (unlimited by default)")
+    parser.add_argument("--tpm", type=int, default=10 ** 12, help="Rate limiter budget (unlimited by default)")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions of the micro benchmarks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-end-to-end", action="store_true")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    ITOM.print_generation_messages()
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    print_table(results, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"meta": metadata(args), "results": results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
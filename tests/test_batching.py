@@ -0,0 +1,42 @@
+"""Tests for packing several contacts into one JSON-mode request."""
+import io
+import json
+
+import ITOM
+
+
+def test_parse_batch_response_keeps_complete_known_rows():
+    items = [
+        {"row_id": 1, "paragraph1": "a", "paragraph2": "b", "paragraph3": "c"},
+        {"row_id": "2", "paragraph1": "d", "paragraph2": "e", "paragraph3": "f"},
+        {"row_id": 3, "paragraph1": "g", "paragraph2": "", "paragraph3": "i"},
+        {"row_id": 9, "paragraph1": "j", "paragraph2": "k", "paragraph3": "l"},
+        {"paragraph1": "m", "paragraph2": "n", "paragraph3": "o"},
+    ]
+    assert ITOM.parse_batch_response(json.dumps(items), {1, 2, 3}) == {1: ["a", "b", "c"], 2: ["d", "e", "f"]}
+
+
+def test_parse_batch_response_tolerates_fences_and_wrappers():
+    item = {"row_id": 4, "paragraph1": "a", "paragraph2": "b", "paragraph3": "c"}
+    fenced = "```json\n" + json.dumps([item]) + "\n```"
+    assert ITOM.parse_batch_response(fenced, {4}) == {4: ["a", "b", "c"]}
+    assert ITOM.parse_batch_response(json.dumps({"emails": [item]}), {4}) == {4: ["a", "b", "c"]}
+    assert ITOM.parse_batch_response(json.dumps(item), {4}) == {4: ["a", "b", "c"]}
+
+
+def test_parse_batch_response_rejects_malformed_json():
+    assert ITOM.parse_batch_response("Error: Too many requests", {1}) == {}
+    assert ITOM.parse_batch_response('"just a string"', {1}) == {}
+
+
+def test_batch_generation_leaves_unanswered_rows_to_the_caller():
+    leads = ITOM.LeadRows(ITOM.read_leads_csv(io.StringIO(ITOM.SAMPLE_CSV)))
+    leads_by_id = {row_id: leads[row_id] for row_id in range(3)}
+    router = ITOM.as_router(ITOM.FakeModel(), ITOM.RateLimiter(10 ** 6, 10 ** 9))
+    answered = ITOM.generate_batch_paragraphs(leads_by_id, "Demo?", "", router, None, ITOM.ROW_PROMPT_TEMPLATE)
+    assert sorted(answered) == [0, 1, 2]
+    assert answered[1][0][0].startswith(leads[1]["First Name"])
+
+    dropping = ITOM.as_router(ITOM.FakeModel(drop_rate=1.0), ITOM.RateLimiter(10 ** 6, 10 ** 9))
+    assert ITOM.generate_batch_paragraphs(leads_by_id, "Demo?", "", dropping, None, ITOM.ROW_PROMPT_TEMPLATE,
+                                          max_requeues=1) == {}
@@ -0,0 +1,94 @@
+"""Tests for the shared Gemini models and the context cache of their prompt prefix, run without network."""
+import types
+
+import pytest
+
+import ITOM
+
+genai = pytest.importorskip("google.generativeai")
+
+
+def test_short_prefix_is_sent_as_the_system_instruction(monkeypatch):
+    def create(**options):
+        raise AssertionError("a prefix below the minimum cacheable size must not be uploaded")
+
+    monkeypatch.setattr(genai.caching.CachedContent, "create", create)
+    prefix = "x" * 4 * 1800
+    model = ITOM.create_prefixed_model(prefix, {}, "gemini-2.0-flash")
+    assert model.prefix_cache is None
+    assert model.prefix_tokens == ITOM.estimate_tokens(prefix)
+    assert prefix in str(model._system_instruction)
+
+
+class Transport:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Client:
+    def __init__(self):
+        self.transport = Transport()
+
+
+class Clock:
+    def __init__(self):
+        self.current = 0.0
+
+    def __call__(self):
+        return self.current
+
+
+@pytest.fixture
+def registry():
+    return ITOM.ClientRegistry(idle_seconds=60, client_factory=lambda api_key: {"generative": Client()},
+                               clock=Clock())
+
+
+@pytest.fixture
+def prefixed_models(monkeypatch):
+    built, deleted = [], []
+
+    def create(prefix, generation_config, model_name, clients):
+        model = types.SimpleNamespace(prefix_cache=f"cachedContents/{len(built)}")
+        built.append(model)
+        return model
+
+    monkeypatch.setattr(ITOM, "create_prefixed_model", create)
+    monkeypatch.setattr(ITOM, "delete_prefix_cache", lambda model, clients=None: deleted.append(model.prefix_cache))
+    return built, deleted
+
+
+def test_sessions_share_clients_and_models(registry):
+    assert registry.clients("key") is registry.clients("key")
+    model = registry.model("key", "gemini-2.0-flash", {"temperature": 0.7})
+    assert registry.model("key", "gemini-2.0-flash", {"temperature": 0.7}) is model
+    assert registry.model("key", "gemini-2.0-flash", {"temperature": 0.2}) is not model
+    assert len(registry) == 2
+
+
+def test_idle_entries_are_evicted_and_their_connections_closed(registry, prefixed_models):
+    built, deleted = prefixed_models
+    idle = registry.clients("idle-key")
+    registry.model("busy-key", "gemini-2.0-flash", {}, prefix="briefing")
+    registry.clock.current = 30
+    busy = registry.clients("busy-key")
+    registry.clock.current = 61
+    registry.clients("other-key")
+    # The model was last used at 0, so it goes, but its key's clients were used at 30
+    assert len(registry) == 0 and deleted == ["cachedContents/0"]
+    assert idle["generative"].transport.closed
+    assert not busy["generative"].transport.closed
+    assert registry.clients("idle-key") is not idle
+
+
+def test_prefixed_models_are_rebuilt_before_their_cache_expires(registry, prefixed_models):
+    built, deleted = prefixed_models
+    first = registry.model(None, "gemini-2.0-flash", {}, prefix="briefing")
+    registry.clock.current = ITOM.PREFIXED_MODEL_MAX_AGE_SECONDS - 1
+    assert registry.model(None, "gemini-2.0-flash", {}, prefix="briefing") is first
+    registry.clock.current = ITOM.PREFIXED_MODEL_MAX_AGE_SECONDS + 1
+    assert registry.model(None, "gemini-2.0-flash", {}, prefix="briefing") is built[1]
+    assert deleted == ["cachedContents/0"]
@@ -0,0 +1,59 @@
+"""Tests for reading large contact lists and writing results as CSV, gzip CSV or Parquet."""
+import gzip
+import io
+
+import pandas as pd
+import pytest
+
+import ITOM
+
+HEADER = "First Name,Last Name,Company,Role,Industry,Country,Notes\n"
+
+
+def csv_text(rows):
+    return HEADER + "".join(f"Ann{i},Lee,Acme {i},CTO,{'Health' if i % 2 else 'Retail'},US,{'' if i % 3 else '007'}\n"
+                            for i in range(rows))
+
+
+def test_read_leads_csv_combines_chunks_into_compact_columns():
+    df = ITOM.read_leads_csv(io.StringIO(csv_text(25)), chunk_size=10)
+    assert len(df) == 25 and list(df.columns) == HEADER.strip().split(",")
+    assert list(df.index) == list(range(25))
+    for col in ITOM.LEAD_CATEGORY_COLUMNS:
+        assert isinstance(df[col].dtype, pd.CategoricalDtype)
+    assert sorted(df["Industry"].cat.categories) == ["Health", "Retail"]
+    # Fields stay text: no number parsing, and blanks stay empty strings
+    assert df["Notes"][0] == "007" and df["Notes"][1] == ""
+    assert df["First Name"][24] == "Ann24"
+
+
+def test_read_leads_csv_requires_the_contact_columns():
+    with pytest.raises(ValueError, match="CSV must contain these columns"):
+        ITOM.read_leads_csv(io.StringIO("First Name,Company\nAnn,Acme\n"))
+    assert len(ITOM.read_leads_csv(io.StringIO(HEADER))) == 0
+
+
+@pytest.mark.parametrize("file_format", ["csv", "csv.gz", "parquet"])
+def test_results_writer_appends_chunks(file_format):
+    chunks = [pd.DataFrame({"Row": [1, 2], "Paragraph1": ["a", "b"]}),
+              pd.DataFrame({"Row": [3], "Paragraph1": [None]})]
+    file = io.BytesIO()
+    writer = ITOM.ResultsWriter(file, file_format)
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.close()
+    data = file.getvalue()
+    if file_format == "parquet":
+        written = pd.read_parquet(io.BytesIO(data))
+        assert list(written["Row"]) == ["1", "2", "3"]
+    else:
+        text = gzip.decompress(data) if file_format == "csv.gz" else data
+        written = pd.read_csv(io.BytesIO(text))
+        assert list(written["Row"]) == [1, 2, 3]
+    assert list(written["Paragraph1"][:2]) == ["a", "b"]
+
+
+def test_results_format_follows_the_extension():
+    assert ITOM.results_format("out.parquet") == "parquet"
+    assert ITOM.results_format("out.csv.gz") == "csv.gz"
+    assert ITOM.results_format("out.csv") == "csv"
@@ -0,0 +1,121 @@
+"""Job store tests: checkpointing, resuming and queueing bulk jobs, on a temporary SQLite file."""
+import io
+
+import pytest
+
+import ITOM
+
+SETTINGS = {"cta": "Would a short demo next week help you?", "custom_text": ""}
+
+
+class CountingModel(ITOM.FakeModel):
+    """FakeModel remembering the prompts it was sent."""
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.prompts = []
+
+    def generate_content(self, contents, *args, **kwargs):
+        self.prompts.append(contents)
+        return super().generate_content(contents, *args, **kwargs)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ITOM.JobStore(str(tmp_path / "jobs.sqlite3"))
+
+
+@pytest.fixture
+def leads():
+    return ITOM.read_leads_csv(io.StringIO(ITOM.SAMPLE_CSV))
+
+
+def run(leads, store, model, **settings):
+    limiter = ITOM.RateLimiter(10 ** 6, 10 ** 9)
+    return ITOM.generate_bulk_emails(leads, dict(SETTINGS, **settings), model, limiter, job_store=store,
+                                     job_id="job")
+
+
+def test_rows_are_checkpointed_to_the_job(leads, store):
+    assert run(leads, store, CountingModel()) is None
+    job = store.list_jobs()[0]
+    assert (job["job_id"], job["status"], job["completed_rows"]) == ("job", "completed", len(leads))
+    assert job["metrics"]["quality"]["passed"] == len(leads)
+    results = store.job_results("job")
+    assert list(results["First Name"]) == list(leads["First Name"])
+    assert all(email.startswith(name) for email, name in zip(results["Paragraph1"], leads["First Name"]))
+
+
+def test_resumed_job_only_generates_unfinished_rows(leads, store):
+    store.start_job("job", len(leads), SETTINGS)
+    store.save_row("job", 1, {}, ["a", "b", "c"], "fake-model", {"status": "passed", "repairs": 0, "found": [],
+                                                                 "issues": []})
+    model = CountingModel()
+    run(leads, store, model)
+    assert len(model.prompts) == len(leads) - 1
+    assert not any(leads["First Name"][1] in prompt for prompt in model.prompts)
+    assert store.list_jobs()[0]["completed_rows"] == len(leads)
+    assert store.job_results("job")["Paragraph1"][1] == "a"
+
+
+def test_failed_rows_are_not_checkpointed(leads, store):
+    run(leads, store, CountingModel(error_rate=1.0), max_repairs=0)
+    job = store.list_jobs()[0]
+    assert (job["status"], job["completed_rows"]) == ("failed", 0)
+    assert store.finished_qualities("job") == {}
+
+
+def test_unfinished_jobs_are_marked_interrupted(store):
+    store.start_job("running", 10, {})
+    store.start_job("done", 10, {})
+    store.set_status("done", "completed")
+    store.interrupt_unfinished_jobs()
+    assert {job["job_id"]: job["status"] for job in store.list_jobs()} == {"running": "interrupted",
+                                                                            "done": "completed"}
+
+
+def submit(store, job_id, owner, key_ids=("k1",)):
+    return store.submit_job(job_id, owner, 10, f"/inputs/{job_id}.parquet", SETTINGS, key_ids=key_ids)
+
+
+def test_claims_favour_owners_with_fewer_running_jobs(store):
+    submit(store, "alice-1", "alice", ["a1"])
+    submit(store, "alice-2", "alice", ["a2"])
+    submit(store, "bob-1", "bob", ["b1"])
+    assert store.claim_next_job()["job_id"] == "alice-1"
+    # Alice already has a running job, so Bob's later job goes before her second one
+    assert store.claim_next_job()["job_id"] == "bob-1"
+    assert store.claim_next_job()["job_id"] == "alice-2"
+    assert store.claim_next_job() is None
+
+
+def test_jobs_sharing_a_key_never_run_together(store):
+    submit(store, "first", "alice", ["k1", "k2"])
+    submit(store, "second", "bob", ["k2"])
+    submit(store, "third", "bob", ["k3"])
+    assert store.claim_next_job()["job_id"] == "first"
+    assert store.claim_next_job()["job_id"] == "third"
+    assert store.claim_next_job() is None
+    store.set_status("first", "completed")
+    assert store.claim_next_job()["job_id"] == "second"
+
+
+def test_submit_never_takes_over_active_or_foreign_jobs(store):
+    assert submit(store, "job", "alice")
+    claimed = store.claim_next_job()
+    assert (claimed["owner"], claimed["input_path"], claimed["settings"]) == ("alice", "/inputs/job.parquet",
+                                                                             SETTINGS)
+    assert not store.can_submit("job", "alice") and not submit(store, "job", "alice")
+    store.set_status("job", "interrupted")
+    assert not store.can_submit("job", "bob") and not submit(store, "job", "bob")
+    # The owner resumes an interrupted job by submitting it again
+    assert store.can_submit("job", "alice") and submit(store, "job", "alice")
+    assert store.list_jobs()[0]["status"] == "queued"
+
+
+def test_daily_request_counts_are_shared_through_the_store(store):
+    store.count_request("key", "gemini-2.0-flash")
+    store.count_request("key", "gemini-2.0-flash")
+    other_process = ITOM.JobStore(store.path)
+    assert other_process.requests_today("key", "gemini-2.0-flash") == 2
+    assert other_process.requests_today("key", "gemini-2.0-flash-lite") == 0
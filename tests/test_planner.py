@@ -0,0 +1,58 @@
+"""Tests for the pre-run cost and duration planner."""
+import io
+import types
+
+import pandas as pd
+import pytest
+
+import ITOM
+
+
+@pytest.fixture(autouse=True)
+def templates(monkeypatch):
+    monkeypatch.setattr(ITOM.st, "session_state", types.SimpleNamespace(
+        template=ITOM.PROMPT_TEMPLATE, row_template=ITOM.ROW_PROMPT_TEMPLATE))
+
+
+@pytest.fixture
+def leads():
+    df = ITOM.read_leads_csv(io.StringIO(ITOM.SAMPLE_CSV))
+    return pd.concat([df] * 10, ignore_index=True)
+
+
+def completed_job(emails, requests, output_tokens, wall_seconds, status="completed"):
+    usage = {"emails": emails, "requests": requests, "output_tokens": output_tokens, "wall_seconds": wall_seconds}
+    return {"status": status, "metrics": {"usage": usage}}
+
+
+def test_plan_counts_requests_and_tokens(leads):
+    plan = ITOM.plan_bulk_run(leads, "Demo?", "", ITOM.FakeModel(), rpm=10 ** 6, tpm=10 ** 9, rpd=1000)
+    assert (plan["rows"], plan["emails"], plan["requests"]) == (len(leads), len(leads), len(leads))
+    assert plan["sampled_rows"] == ITOM.PLANNER_SAMPLE_SIZE
+    assert plan["prefix_tokens"] == ITOM.estimate_tokens(ITOM.build_prompt_prefix(ITOM.PROMPT_TEMPLATE))
+    assert plan["output_tokens"] == len(leads) * ITOM.EXPECTED_OUTPUT_TOKENS
+    assert plan["input_tokens"] > len(leads) * plan["prefix_tokens"]
+    assert not plan["observed"]
+    assert plan["bottleneck"] == "model latency and concurrency"
+
+
+def test_batches_and_segments_cut_requests(leads):
+    batched = ITOM.plan_bulk_run(leads, "Demo?", "", ITOM.FakeModel(), rpm=1, tpm=10 ** 9, rpd=3, batch_size=8,
+                                 max_concurrency=16)
+    assert batched["requests"] == 7
+    assert batched["bottleneck"] == "requests per minute"
+    assert (batched["fits_daily_quota"], batched["days_needed"]) == (False, 3)
+    segmented = ITOM.plan_bulk_run(leads, "Demo?", "", ITOM.FakeModel(), rpm=10, tpm=10 ** 9, rpd=1000,
+                                   segment_columns=["Role", "Industry", "Country"])
+    assert segmented["emails"] == segmented["requests"] == len(leads) // 10
+
+
+def test_plan_learns_from_completed_jobs(leads):
+    jobs = [completed_job(10, 5, 2000, 20.0), completed_job(30, 15, 4000, 60.0),
+            completed_job(100, 100, 10 ** 6, 10 ** 4, status="failed")]
+    plan = ITOM.plan_bulk_run(leads, "Demo?", "", ITOM.FakeModel(), rpm=10 ** 6, tpm=10 ** 9, rpd=1000,
+                              max_concurrency=4, jobs=jobs)
+    assert plan["observed"]
+    assert plan["output_tokens_per_email"] == pytest.approx(150)
+    assert plan["seconds_per_request"] == pytest.approx(4.0)
+    assert plan["eta_minutes"] == pytest.approx(len(leads) * 4.0 / 4 / 60)
@@ -0,0 +1,51 @@
+"""Tests for live partial results and generating chosen rows first."""
+import io
+
+import pytest
+
+import ITOM
+
+
+def test_parse_row_ranges():
+    assert ITOM.parse_row_ranges("3, 1-2, 2", 10) == [2, 0, 1]
+    assert ITOM.parse_row_ranges(" 8-20 ", 10) == [7, 8, 9]
+    assert ITOM.parse_row_ranges("0, 11", 10) == []
+    assert ITOM.parse_row_ranges("", 10) == []
+
+
+@pytest.mark.parametrize("text", ["abc", "1-", "2..4", "-3"])
+def test_parse_row_ranges_rejects_other_input(text):
+    with pytest.raises(ValueError):
+        ITOM.parse_row_ranges(text, 10)
+
+
+def test_latest_results_are_the_newest_finished_rows(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ITOM.time, "time", lambda: now[0])
+    store = ITOM.JobStore(str(tmp_path / "jobs.sqlite3"))
+    store.start_job("job", 5, {})
+    for row_index in [4, 0, 2]:
+        now[0] += 1
+        store.save_row("job", row_index, {"First Name": f"Ann{row_index}"}, ["a", "b", "c"], "m")
+    latest = store.latest_results("job", 2)
+    assert list(latest["Row"]) == [3, 1]
+    assert list(latest["First Name"]) == ["Ann2", "Ann0"]
+    assert list(store.job_results("job")["First Name"]) == ["Ann0", "Ann2", "Ann4"]
+
+
+def test_priority_rows_are_generated_first(tmp_path):
+    leads = ITOM.read_leads_csv(io.StringIO(ITOM.SAMPLE_CSV))
+    store = ITOM.JobStore(str(tmp_path / "jobs.sqlite3"))
+    order = []
+    model = ITOM.FakeModel()
+    generate_content = model.generate_content
+
+    def record_order(prompt, *args, **kwargs):
+        order.append(next(name for name in leads["First Name"] if f"First Name: {name}\n" in prompt))
+        return generate_content(prompt, *args, **kwargs)
+
+    model.generate_content = record_order
+    settings = {"cta": "Demo?", "custom_text": "", "priority": [3, 1]}
+    ITOM.generate_bulk_emails(leads, settings, model, ITOM.RateLimiter(10 ** 6, 10 ** 9), job_store=store,
+                              job_id="job")
+    assert order == [leads["First Name"][pos] for pos in [3, 1, 0, 2, 4]]
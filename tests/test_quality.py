@@ -0,0 +1,133 @@
+"""Tests for the template writing rules and the repair of emails that break them."""
+import json
+
+import pytest
+
+import ITOM
+
+RULES = ["second_person", "no_placeholders", "no_signature"]
+GOOD_EMAIL = [
+    "Ann, as CTO at Acme you keep hospital networks running.",
+    "OpManager Plus watches servers, networks and applications from one console.",
+    "Would a short demo next week help your team?",
+]
+
+
+class ScriptedModel:
+    """Model returning queued response texts in order and remembering the prompts it was sent."""
+
+    model_name = "scripted-model"
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.prompts = []
+
+    def generate_content(self, prompt, generation_config=None, **kwargs):
+        self.prompts.append(prompt)
+        return ITOM.FakeResponse(self.responses.pop(0))
+
+
+def scripted_router(responses):
+    model = ScriptedModel(responses)
+    return model, ITOM.as_router(model, ITOM.RateLimiter(10 ** 6, 10 ** 9))
+
+
+def test_template_rules_come_from_the_prompt_template():
+    assert ITOM.template_quality_rules(ITOM.PROMPT_TEMPLATE) == RULES
+    assert ITOM.template_quality_rules("Write an email.") == []
+
+
+def test_good_email_passes():
+    assert ITOM.validate_email_paragraphs(GOOD_EMAIL, RULES) == []
+
+
+def test_empty_paragraphs_are_flagged():
+    assert ITOM.validate_email_paragraphs([GOOD_EMAIL[0], "", GOOD_EMAIL[2]], RULES) == [(1, "empty")]
+
+
+def test_second_person_is_checked_across_the_whole_email():
+    # A product paragraph without "you" is fine while the email addresses the recipient elsewhere
+    assert "you" not in GOOD_EMAIL[1]
+    assert ITOM.validate_email_paragraphs(GOOD_EMAIL, ["second_person"]) == []
+    impersonal = ["Acme runs hospital networks.", "OpManager Plus watches them.", "A demo is available."]
+    assert ITOM.validate_email_paragraphs(impersonal, ["second_person"]) == [(0, "second_person")]
+
+
+@pytest.mark.parametrize("text", [
+    "See [Case Study Link] for details, you will like it.",
+    "Hi {first_name}, you run IT.",
+    "Dear <Company Name> team, you run IT.",
+    "Call you at XXX-1234.",
+    "Pricing for you: TBD.",
+])
+def test_placeholders_are_flagged(text):
+    assert ITOM.validate_email_paragraphs([text, GOOD_EMAIL[1], GOOD_EMAIL[2]], ["no_placeholders"]) == [
+        (0, "no_placeholders"),
+    ]
+
+
+@pytest.mark.parametrize("text", [
+    "You need latency < 5 ms and jitter > 2 ms on your links.",
+    "If a < b and c > d, you still see every device.",
+])
+def test_comparisons_are_not_placeholders(text):
+    assert ITOM.validate_email_paragraphs([text, GOOD_EMAIL[1], GOOD_EMAIL[2]], ["no_placeholders"]) == []
+
+
+def test_signatures_are_flagged():
+    ending = "Would a short demo next week help you?\n\nBest regards,"
+    assert ITOM.validate_email_paragraphs([GOOD_EMAIL[0], GOOD_EMAIL[1], ending], ["no_signature"]) == [
+        (2, "no_signature"),
+    ]
+    assert ITOM.validate_email_paragraphs(["Thanks to you, it works.", *GOOD_EMAIL[1:]], ["no_signature"]) == []
+
+
+def test_rules_not_in_the_template_are_not_checked():
+    assert ITOM.validate_email_paragraphs(["[Name]", "Best regards,", "No one here."], []) == []
+
+
+def test_repair_passes_a_good_email_without_requests():
+    model, router = scripted_router([])
+    paragraphs, model_name, quality = ITOM.repair_email_paragraphs("prompt", GOOD_EMAIL, "m", router, RULES)
+    assert (paragraphs, model_name) == (GOOD_EMAIL, "m")
+    assert quality == {"status": "passed", "repairs": 0, "found": [], "issues": []}
+    assert model.prompts == []
+
+
+def test_repair_rewrites_only_the_failing_paragraph():
+    draft = [GOOD_EMAIL[0], "See [Case Study Link].", GOOD_EMAIL[2]]
+    model, router = scripted_router([json.dumps({"paragraph": "The case study shows a 40% faster fix time."})])
+    paragraphs, _, quality = ITOM.repair_email_paragraphs("prompt", draft, "m", router, RULES)
+    assert paragraphs == [GOOD_EMAIL[0], "The case study shows a 40% faster fix time.", GOOD_EMAIL[2]]
+    assert quality == {"status": "repaired", "repairs": 1, "found": ["no_placeholders"], "issues": []}
+    assert len(model.prompts) == 1
+    assert "Rewrite only paragraph 2" in model.prompts[0]
+    assert "paragraph 2 contains placeholder text" in model.prompts[0]
+
+
+def test_repair_regenerates_the_whole_email_when_every_paragraph_fails():
+    draft = ["[Intro]", "[Body]", "Best regards,"]
+    model, router = scripted_router([ITOM.email_response_json(GOOD_EMAIL)])
+    paragraphs, model_name, quality = ITOM.repair_email_paragraphs("prompt", draft, "m", router, RULES)
+    assert paragraphs == GOOD_EMAIL
+    assert model_name == "scripted-model"
+    assert quality["status"] == "repaired" and quality["repairs"] == 1
+    assert model.prompts == ["prompt"]
+
+
+def test_repair_gives_up_after_max_repairs():
+    draft = [GOOD_EMAIL[0], "See [Case Study Link].", GOOD_EMAIL[2]]
+    still_broken = json.dumps({"paragraph": "See [Another Link]."})
+    model, router = scripted_router([still_broken, still_broken])
+    paragraphs, _, quality = ITOM.repair_email_paragraphs("prompt", draft, "m", router, RULES, max_repairs=2)
+    assert quality == {"status": "failed", "repairs": 2, "found": ["no_placeholders"],
+                       "issues": [(1, "no_placeholders")]}
+    assert paragraphs[1] == "See [Another Link]."
+
+
+def test_repair_leaves_errors_alone():
+    model, router = scripted_router([])
+    error = ["Error: Too many requests", "", ""]
+    paragraphs, _, quality = ITOM.repair_email_paragraphs("prompt", error, "", router, RULES)
+    assert paragraphs == error and quality["status"] == "error"
+    assert model.prompts == []
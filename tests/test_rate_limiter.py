@@ -0,0 +1,93 @@
+"""Rate limiter tests, run offline on a FakeClock."""
+import pytest
+
+import ITOM
+
+
+def make_limiter(rpm=60, tpm=10 ** 9, **options):
+    clock = ITOM.FakeClock()
+    return ITOM.RateLimiter(rpm, tpm, clock=clock, jitter=0, **options), clock
+
+
+def test_paces_requests_at_the_rpm_interval():
+    limiter, clock = make_limiter(rpm=60)
+    for _ in range(5):
+        limiter.acquire()
+    assert clock.sleeps == pytest.approx([1.0, 1.0, 1.0, 1.0])
+    assert clock.now() == pytest.approx(4.0)
+
+
+def test_paces_requests_by_token_budget():
+    limiter, clock = make_limiter(rpm=10 ** 6, tpm=6000)
+    limiter.acquire(100)
+    limiter.acquire(100)
+    # 6,000 tokens per minute refill 100 tokens per second
+    assert clock.now() == pytest.approx(1.0)
+
+
+def test_oversized_request_waits_for_a_full_bucket_and_its_debt_paces_the_next():
+    limiter, clock = make_limiter(rpm=10 ** 6, tpm=6000)
+    limiter.acquire(1000)
+    assert clock.now() == 0.0
+    limiter.acquire(100)
+    # The 900 tokens over the 100-token bucket and the next 100 refill at 100 tokens per second
+    assert clock.now() == pytest.approx(10.0)
+
+
+def test_try_acquire_does_not_wait():
+    limiter, clock = make_limiter(rpm=60)
+    assert limiter.try_acquire()
+    assert not limiter.try_acquire()
+    assert limiter.wait_time() == pytest.approx(1.0)
+    clock.advance(1.0)
+    assert limiter.try_acquire()
+    assert clock.sleeps == []
+
+
+def test_throttle_halves_rate_and_success_recovers_it():
+    limiter, _ = make_limiter(min_scale=0.2, increase_step=0.05)
+    limiter.on_throttle(0)
+    assert limiter.scale == pytest.approx(0.5)
+    limiter.on_throttle(0)
+    limiter.on_throttle(0)
+    assert limiter.scale == pytest.approx(0.2)
+    limiter.on_success()
+    assert limiter.scale == pytest.approx(0.25)
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.scale == 1.0
+    assert limiter.throttle_count == 3
+
+
+def test_throttled_limiter_paces_slower():
+    limiter, clock = make_limiter(rpm=60)
+    limiter.acquire()
+    limiter.on_throttle(0)
+    limiter.acquire()
+    # Half the rate: the next request slot refills in two seconds
+    assert clock.now() == pytest.approx(2.0)
+
+
+def test_retry_after_blocks_every_caller():
+    limiter, clock = make_limiter(rpm=60)
+    assert limiter.on_throttle(7) == pytest.approx(7.0)
+    assert limiter.headroom() == 0.0
+    assert limiter.wait_time() == pytest.approx(7.0)
+    limiter.acquire()
+    assert clock.now() == pytest.approx(7.0)
+
+
+def test_backoff_doubles_without_retry_after_and_resets_on_success():
+    limiter, _ = make_limiter(base_backoff=2.0, max_backoff=5.0)
+    assert limiter.on_throttle() == pytest.approx(2.0)
+    assert limiter.on_throttle() == pytest.approx(4.0)
+    assert limiter.on_throttle() == pytest.approx(5.0)
+    limiter.on_success()
+    limiter.on_throttle()
+    assert limiter.consecutive_throttles == 1
+
+
+def test_parse_retry_delay():
+    assert ITOM.parse_retry_delay(ITOM.FakeRateLimitError("429 Please retry in 3.5s.")) == 3.5
+    assert ITOM.parse_retry_delay(RuntimeError("429 retry_delay { seconds: 12 }")) == 12.0
+    assert ITOM.parse_retry_delay(RuntimeError("500 internal error")) is None
@@ -0,0 +1,55 @@
+"""Response cache tests on a temporary SQLite file."""
+import pytest
+
+import ITOM
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ITOM.time, "time", lambda: now[0])
+    return now
+
+
+def test_lookup_returns_the_response_and_model_and_counts_hits(tmp_path):
+    cache = ITOM.ResponseCache(str(tmp_path / "cache.sqlite3"))
+    assert cache.lookup("k") is None
+    cache.put("k", "email", "gemini-2.0-flash")
+    assert cache.lookup("k") == ("email", "gemini-2.0-flash")
+    assert cache.get("k") == "email"
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_entries_expire_after_max_age(tmp_path, clock):
+    cache = ITOM.ResponseCache(str(tmp_path / "cache.sqlite3"), max_age_seconds=60)
+    cache.put("k", "email")
+    clock[0] += 60
+    assert cache.get("k") == "email"
+    clock[0] += 1
+    assert cache.get("k") is None
+    # Reopening the cache purges expired entries
+    assert len(ITOM.ResponseCache(cache.path, max_age_seconds=60)) == 0
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(ITOM, "RESPONSE_CACHE_EVICT_EVERY", 1)
+    cache = ITOM.ResponseCache(str(tmp_path / "cache.sqlite3"), max_entries=2)
+    cache.put("a", "1")
+    clock[0] += 1
+    cache.put("b", "2")
+    clock[0] += 1
+    assert cache.get("a") == "1"
+    clock[0] += 1
+    cache.put("c", "3")
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == "1" and cache.get("c") == "3"
+
+
+def test_cache_keys_depend_on_prompt_and_namespace():
+    namespace = ITOM.response_cache_namespace("prefix", {"temperature": 0.7}, ["gemini-2.0-flash"])
+    key = ITOM.response_cache_key(namespace, "prompt")
+    assert key == ITOM.response_cache_key(namespace, "prompt")
+    assert key != ITOM.response_cache_key(namespace, "other prompt")
+    other = ITOM.response_cache_namespace("prefix", {"temperature": 0.2}, ["gemini-2.0-flash"])
+    assert key != ITOM.response_cache_key(other, "prompt")
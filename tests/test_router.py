@@ -0,0 +1,66 @@
+"""Model routing and API key pool tests, run offline."""
+import pandas as pd
+import pytest
+
+import ITOM
+
+
+def make_route(name, limiter, key=None, prefix=None, model=None):
+    model = model or ITOM.FakeModel(system_instruction=prefix, model_name=name)
+    return ITOM.ModelRoute(name, model, limiter, key=key)
+
+
+class RejectedKeyModel:
+    def generate_content(self, *args, **kwargs):
+        raise RuntimeError("400 API key not valid. Please pass a valid API key.")
+
+
+def test_router_charges_the_prompt_prefix_to_every_request():
+    clock = ITOM.FakeClock()
+    limiter = ITOM.RateLimiter(10 ** 6, 6000, clock=clock, jitter=0)
+    router = ITOM.ModelRouter([make_route("a", limiter, prefix="x" * 396)])
+    assert router.routes[0].prefix_tokens == 100
+    router.acquire(0)
+    router.acquire(0)
+    # 6,000 tokens per minute refill the 100-token prefix in one second
+    assert clock.now() == pytest.approx(1.0)
+
+
+def test_router_spills_over_to_the_next_model():
+    clock = ITOM.FakeClock()
+    first = ITOM.RateLimiter(60, 10 ** 9, clock=clock, jitter=0)
+    second = ITOM.RateLimiter(60, 10 ** 9, clock=clock, jitter=0)
+    router = ITOM.ModelRouter([make_route("a", first), make_route("b", second)])
+    assert [router.acquire()[0].name for _ in range(3)] == ["a", "b", "a"]
+    assert clock.now() == pytest.approx(1.0)
+
+
+def test_router_never_falls_back_to_quarantined_keys():
+    key = ITOM.ApiKey("rejected")
+    router = ITOM.ModelRouter([make_route("a", ITOM.RateLimiter(60, 10 ** 9), key=key)])
+    key.quarantine(60, "invalid")
+    with pytest.raises(ITOM.NoAvailableModelError):
+        router.acquire()
+
+
+def test_rejected_key_is_quarantined_and_the_next_key_answers():
+    pool = ITOM.ApiKeyPool(["key-1111", "key-2222"], client_factory=lambda api_key: {})
+    rejected, working = pool.keys
+    router = ITOM.ModelRouter([
+        make_route("a", ITOM.RateLimiter(10 ** 6, 10 ** 9), key=rejected, model=RejectedKeyModel()),
+        make_route("a", ITOM.RateLimiter(10 ** 6, 10 ** 9), key=working),
+    ])
+    text = ITOM.generate_email_content("First Name: Ann", router)
+    assert text.startswith("Ann")
+    assert not rejected.is_available() and rejected.quarantine_reason == "invalid"
+    assert pool.available_keys() == [working]
+
+
+def test_edited_model_limits_fall_back_to_defaults_for_cleared_cells():
+    table = pd.DataFrame({"RPM": [20, None], "TPM": [float("nan"), 500], "RPD": ["x", 0]},
+                         index=["gemini-2.0-flash", "custom-model"])
+    assert ITOM.edited_model_limits(table) == {
+        "gemini-2.0-flash": {"rpm": 20, "tpm": ITOM.MODEL_LIMITS["gemini-2.0-flash"]["tpm"],
+                             "rpd": ITOM.MODEL_LIMITS["gemini-2.0-flash"]["rpd"]},
+        "custom-model": {"rpm": ITOM.DEFAULT_RPM_LIMIT, "tpm": 1000, "rpd": 1},
+    }
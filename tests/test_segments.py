@@ -0,0 +1,37 @@
+"""Tests for segment mode: one generated email per segment, re-addressed to each member."""
+import pandas as pd
+
+import ITOM
+
+SEGMENT = ["Role", "Industry", "Country"]
+
+
+def test_group_segments_normalizes_case_and_whitespace():
+    df = pd.DataFrame({"Role": ["CTO", " cto", "CIO", "CTO"], "Industry": ["Health"] * 4,
+                       "Country": ["US", "us", "US", "UK"]})
+    assert ITOM.group_segments(ITOM.LeadRows(df), range(4), SEGMENT) == {0: [1], 2: [], 3: []}
+    assert ITOM.count_segments(df, SEGMENT) == 3
+
+
+def test_personalize_paragraphs_readdresses_segment_members():
+    source = {"First Name": "Ann", "Last Name": "Lee", "Company": "Acme", "Role": "CTO"}
+    target = {"First Name": "Annabel", "Last Name": "Kim", "Company": "Acme", "Role": "CTO"}
+    paragraphs = ["Ann, as CTO at Acme you know Lee family values.", "Hi Ann Lee.", "Annual review?"]
+    assert ITOM.personalize_paragraphs(paragraphs, source, target, ["First Name", "Last Name", "Company"]) == [
+        "Annabel, as CTO at Acme you know Kim family values.", "Hi Annabel Kim.", "Annual review?",
+    ]
+
+
+def test_personalize_paragraphs_prefers_longest_values():
+    source = {"Company": "Data", "Industry": "Data Centers"}
+    target = {"Company": "Flow", "Industry": "Logistics"}
+    assert ITOM.personalize_paragraphs(["Data Centers at Data"], source, target, ["Company", "Industry"]) == [
+        "Logistics at Flow",
+    ]
+
+
+def test_personalize_paragraphs_without_differences_copies():
+    lead = {"First Name": "Ann"}
+    paragraphs = ["Hi Ann"]
+    result = ITOM.personalize_paragraphs(paragraphs, lead, dict(lead), ["First Name"])
+    assert result == paragraphs and result is not paragraphs
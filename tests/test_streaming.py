@@ -0,0 +1,70 @@
+"""Tests for streaming the sample email paragraph by paragraph."""
+import ITOM
+
+
+def feed_all(parser, chunks):
+    completed = []
+    for chunk in chunks:
+        completed.extend(parser.feed(chunk))
+    return completed
+
+
+def test_stream_parser_yields_paragraphs_as_they_complete():
+    parser = ITOM.ParagraphStreamParser()
+    assert parser.feed("\n\nHi Ann, as IT Director") == []
+    assert parser.feed(" you run a lot.\n\nSecond ") == ["Hi Ann, as IT Director you run a lot."]
+    assert parser.feed("paragraph.\n") == []
+    assert parser.feed("\nThird paragraph.") == ["Second paragraph."]
+    assert parser.finish() == ["Third paragraph."]
+    assert parser.paragraphs == ["Hi Ann, as IT Director you run a lot.", "Second paragraph.", "Third paragraph."]
+
+
+def test_stream_parser_matches_parse_email_paragraphs():
+    text = "# Subject\n\nFirst.\n\n---\n\nSecond.\n\nThird.\n\n"
+    parser = ITOM.ParagraphStreamParser()
+    streamed = feed_all(parser, [text[i:i + 3] for i in range(0, len(text), 3)]) + parser.finish()
+    assert streamed == ITOM.parse_email_paragraphs(text) == ["First.", "Second.", "Third."]
+
+
+class Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class CancellableStream:
+    """Streaming response that records how far it was read and whether it was cancelled."""
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.read = 0
+        self.cancelled = False
+
+    def __iter__(self):
+        for text in self.texts:
+            if self.cancelled:
+                return
+            self.read += 1
+            yield Chunk(text)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class StreamingModel:
+    model_name = "streaming-model"
+
+    def __init__(self, response):
+        self.response = response
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        return self.response
+
+
+def test_stream_stops_once_three_paragraphs_are_complete():
+    response = CancellableStream(["One.\n\nTwo.", "\n\nThree.\n\n", "Four.\n\n", "Five."])
+    router = ITOM.as_router(StreamingModel(response), ITOM.RateLimiter(10 ** 6, 10 ** 9))
+    answered = []
+    paragraphs = list(ITOM.stream_email_paragraphs("prompt", router, on_model=answered.append))
+    assert paragraphs == ["One.", "Two.", "Three."]
+    assert response.cancelled and response.read == 2
+    assert answered == ["streaming-model"]